@@ -14,6 +14,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 from scipy.integrate import odeint
 from matplotlib import gridspec
+from pabmodels import pab1_v4
 
 
 # Parameters from von der Haar 2008
@@ -29,63 +30,31 @@ estimated_HSP104_hs = 250 #molecules/cell
 # *A quantitative estimation of the global transcriptional activity in logarithmically growing yeast cells by von der Haar 
 # &Drummond 2015
 
+# Right-hand side and exact Jacobian both generated from the reactions of
+# pab1_v4 (see pabmodels), at the temperature T set below for each stage.
+model = pab1_v4(total_Pab1).compile()
+
 def deriv(z, t):
-    Ea = 80. # assembly reaction activation energy (arb. units for now)
-    Ea2 = 125. # mRNA production activation energy (arb. units)
-    k1 = .01*np.exp(Ea*(1-(303./T))) # Deactivation (M^-1*min^-1)
-    k2 = .0000005 # Reactivation 
-    k3 = 1000 # Protein synthesis M^-1*min^-1
-    #k4 = HSP104_deg # Protein degradation
-    k4 = 0.005 #Protein degradation
-    k5 = .1*np.exp(Ea2*(1-(303./T))) # mRNA production rate (min^-1)
-    k6 = .18 # Pab-mRNA on rate s^-1 $
-    km6 = 1.8 # Pab-mRNA off rate s^-1 $
-    k7 = .03 # mRNA decay rate    
-
-# $ from Sachs 1987
-    
-    Pab = z[0]
-    iPab = z[1]
-    C = z[2]
-    mRNAC = z[3]
-    Pab_mRNAC = z[4]
-    mRNAB = z[5]
-    Pab_mRNAB = z[6]
-        
-    diPab = k1*Pab - k2*iPab*C
-    dC = k3*mRNAC - k4*C
-    dmRNAB = km6*Pab_mRNAB - k6*Pab*mRNAB
-    dPab_mRNAB = k6*Pab*mRNAB - km6*Pab_mRNAB
-    
-    # For Pab-dependent model
-    dPab = -k1*Pab + k2*iPab*C - k6*Pab*mRNAC + km6*Pab_mRNAC - k6*Pab*mRNAB + km6*Pab_mRNAB
-    dmRNAC = k5 - k6*Pab*mRNAC + km6*Pab_mRNAC - k7*mRNAC    
-    dPab_mRNAC = k6*Pab*mRNAC - km6*Pab_mRNAC
-    
-    # For Pab-independent model
-#    dPab = -k1*Pab + k2*iPab*C - k6*Pab*mRNAB + km6*Pab_mRNAB
-#    dmRNAC = k5 - k7*mRNAC
-#    dPab_mRNAC = 0
-    
-    
-    return np.array([dPab, diPab, dC, dmRNAC, dPab_mRNAC, dmRNAB, dPab_mRNAB])
- #   return np.array([dPab, diPab, dC, dmRNAC, dPab_mRNAC])
+    return model.deriv(z, t, T)
+
+def jac(z, t):
+    return model.jac(z, t, T)
 
 
 T = 303 
 time1 = np.arange(0, 60.0, .01)
 zinit = np.array([total_Pab1, 0, total_HSP104, 5, 0, total_cellular_mRNA, 0])
-z1 = odeint(deriv, zinit, time1)
+z1 = odeint(deriv, zinit, time1, Dfun=jac)
 Tlist = [T, T]
 
 T = 317
 time2 = np.arange(60.0, 70.0, .01)
-z2 = odeint(deriv, z1[-1], time2)
+z2 = odeint(deriv, z1[-1], time2, Dfun=jac)
 Tlist.append(T)
 
 T = 303
 time3 = np.arange(70.0, 400.0, .01)
-z3 = odeint(deriv, z2[-1], time3)
+z3 = odeint(deriv, z2[-1], time3, Dfun=jac)
 Tlist.append(T)
 
 times = np.concatenate((time1, time2, time3))
@@ -6,8 +6,9 @@ Species: Pab, iPab, C, mRNAC, Pab_mRNAC
 
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.integrate import odeint
 from matplotlib import gridspec
+from odedriver import integrate
+from pabmodels import pab1_v5
 
 
 # Parameters from von der Haar 2008
@@ -22,67 +23,20 @@ estimated_HSP104_hs = 250 #molecules/cell
 # *A quantitative estimation of the global transcriptional activity in logarithmically growing yeast cells by von der Haar 
 # &Drummond 2015
 
-def deriv(z, t):
-    Ea = 80. # assembly reaction activation energy (arb. units)
-    Ea2 = 125. # mRNA production activation energy (arb. units)
-    k1 = .01*np.exp(Ea*(1-(303./T))) # Deactivation
-    k2 = .0000005 # Reactivation 
-    k3 = 1000 # Protein synthesis min^-1
-    #k4 = HSP104_deg # Protein degradation
-    k4 = 0.005 #Protein degradation
-    k5 = .1*np.exp(Ea2*(1-(303./T))) # mRNA production rate (min^-1)
-#    k6 = 105 # Pab-mRNA on rate min^-1 $
-#    km6 = 1.8 # Pab-mRNA off rate min^-1 $
-    k6 = .18 # Pab-mRNA on rate min^-1 $
-    km6 = 1.8 # Pab-mRNA off rate min^-1 $
-    k7 = 0.03 # mRNA decay rate    
+# The rates live in pab1_v5 (see pabmodels) only; deriv and the exact
+# Jacobian given to LSODA are both generated from it.
+model = pab1_v5(total_Pab1).compile()
 
-# $ from Sachs 1987
-    
-    Pab = z[0]
-    iPab = z[1]
-    C = z[2]
-    mRNAC = z[3]
-    Pab_mRNAC = z[4]
-        
-    diPab = k1*Pab - k2*iPab*C
-    dC = k3*mRNAC - k4*C
-    
-    # For Pab-dependent model
-    dPab = -k1*Pab + k2*iPab*C - k6*Pab*mRNAC + km6*Pab_mRNAC
-    dmRNAC = k5 - k6*Pab*mRNAC + km6*Pab_mRNAC - k7*mRNAC    
-    dPab_mRNAC = k6*Pab*mRNAC - km6*Pab_mRNAC
-    
-    # For Pab-independent model
-#    dPab = -k1*Pab + k2*iPab*C
-#    dmRNAC = k5 - k7*mRNAC
-#    dPab_mRNAC = 0
-    
-    
-    return np.array([dPab, diPab, dC, dmRNAC, dPab_mRNAC])
- #   return np.array([dPab, diPab, dC, dmRNAC, dPab_mRNAC])
-
-
-T = 303 
-time1 = np.arange(0, 10.0, .01)
+# Heat shock from 10 to 20 min; the integrator restarts at each change of
+# temperature and the dense solution is sampled for plotting.
+temp_fxn = [(0, 303), (10.0, 317), (20.0, 303)]
 zinit = np.array([total_Pab1, 0, total_HSP104, 5, 0])
-z1 = odeint(deriv, zinit, time1)
-Tlist = [T, T]
-
-T = 317
-time2 = np.arange(10.0, 20.0, .01)
-z2 = odeint(deriv, z1[-1], time2)
-Tlist.append(T)
-
-T = 303
-time3 = np.arange(20.0, 100.0, .01)
-z3 = odeint(deriv, z2[-1], time3)
-Tlist.append(T)
-
-times = np.concatenate((time1, time2, time3))
-final = np.vstack((z1, z2, z3))
+course = integrate(model.deriv, zinit, 0, 100.0, temp_fxn, jac=model.jac)
+times = np.arange(0, 100.0, .01)
+final = course.sample(times)
+Tlist = [303, 303, 317, 303]
 
-print('Total C mRNA after heat shock: ' + str(z2[-1, 3] + z2[-1, 4]))
+print('Total C mRNA after heat shock: ' + str(course(20.0)[3] + course(20.0)[4]))
 
 # Plots
 names = ['$Pab1$', '$iPab1$', '$C$', '$free mRNA_C$', '$Pab1:mRNA_C$']
@@ -91,7 +45,7 @@ colors = ['royalblue', 'firebrick', 'gold', 'darkgreen', 'k']
 f = plt.figure(figsize=(8, 5))
 gs = gridspec.GridSpec(2, 1, height_ratios=[1, 5])
 ax2 = plt.subplot(gs[0])
-ax2.step([time1[0], time1[-1], time2[-1], time3[-1]], Tlist, c='k')
+ax2.step([0, 10.0, 20.0, 100.0], Tlist, c='k')
 ax2.set_ylabel('$\Delta$ T (K)')
 ax2.set_ylim(290, 320)
 plt.setp(ax2.get_xticklabels(), visible=False)
@@ -0,0 +1,309 @@
+#!/usr/bin/python
+"""
+Benchmarks of the simulators on reference workloads from the scripts.
+
+Each workload rebuilds the model of one of the scripts, which run and plot
+when imported (and a copy keeps the baseline comparable when they are
+edited): the birth-death model of lemming.py (gsim), reactivation_A.py
+with the schedule [(1, 298), (30, 315), (60, 298)] and the network of
+pabchaperone_translation.py at 10^3, 10^4 and 10^5 copies (gsim_A), and
+the timecourses of ODE-v5.py and zheng-2016.py (odedriver.integrate).
+Each is run in a fresh process, so that its peak memory can be read. A
+round repeats the workload until at least min_time seconds of it have
+been timed, so that short workloads are not measured at the resolution of
+the timer; the wall time per run is the best of the rounds. Also reported
+are the SSA events and events per second (steps for tau-leaping) or the
+ODE right-hand side and Jacobian evaluations per run, and the peak
+resident memory.
+
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json        # exit 1 on regressions
+    python benchmark.py pab1e4 pab1e5 --ssa-method array
+
+The result cache is disabled while the workloads run.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+WORKLOADS = ["lemming", "reactivation_A", "pab1e3", "pab1e4", "pab1e5",
+             "ode_v5", "zheng_2016"]
+ODE_WORKLOADS = ("ode_v5", "zheng_2016")
+
+
+class _Counted(object):
+    """A function which counts its calls."""
+    def __init__(self, f):
+        self.f = f
+        self.calls = 0
+
+    def __call__(self, *args):
+        self.calls += 1
+        return self.f(*args)
+
+
+def _events(x, first):
+    """Number of rows of a trajectory whose counts (columns from first on)
+    differ from the previous row."""
+    x = np.asarray(x)
+    return int(np.count_nonzero(np.any(np.diff(x[:, first:], axis=0) != 0, axis=1)))
+
+
+def lemming(method):
+    from gsim import Species, ConstInduction, UniDeg, Network
+    L = Species("Lemming", 0)
+    arrival = ConstInduction("Induction", None, [L], 1.0)
+    jump = UniDeg("Degredation", [L], None, 0.1)
+    net = Network([L], [arrival, jump])
+    return lambda: {"events": _events(net.simulate(0, 200, None, method=method,
+                                                   seed=1), 1)}
+
+
+def reactivation_A(method):
+    from gsim_A import Species, Network, UniDeg
+    from reactivation_A import (MonomerReactivation, HeatInducedProduction,
+                                HeatInducedInactivation, Temp_Dimerization)
+    A = Species("A", 100)
+    AA = Species("AA", 0)
+    iAA = Species("iAA", 0)
+    C = Species("C", 10)
+    rxns = [HeatInducedInactivation("Inactivation", [AA], [iAA], None, 0.001),
+            MonomerReactivation("Disagg", [iAA, C], [A, C], None, 0.01),
+            HeatInducedProduction("Heat Induced Production", [iAA], [C], None, 0.05),
+            UniDeg("C Degredation", [C], [None], None, 0.1),
+            Temp_Dimerization("Dimerization", [A], [AA], None, 0.0001)]
+    net = Network([A, AA, iAA, C], rxns)
+    temp_fxn = [(1, 298), (30, 315), (60, 298)]
+    return lambda: {"events": _events(net.simulate(0, 70, temp_fxn, None,
+                                                   method=method, seed=1), 2)}
+
+
+def pab_translation(copies, method):
+    """pabchaperone_translation.py with copies of Pab1 (100 in the script)
+    and half as many chaperones, at the script's rates. Every reaction is
+    first order (Pab1Reactivation only counts iPab1), so the rates need no
+    scaling with the copy number."""
+    from gsim_A import Species, Network, UniDeg
+    from pabchaperone_translation import (Pab1Deactivation, Pab1Reactivation,
+                                          CProduction)
+    Pab1 = Species("Pab1", int(copies))
+    C = Species("Chaperone", int(copies/2))
+    iPab1 = Species("iPab1", 0)
+    rxns = [Pab1Deactivation("agg", [Pab1], [iPab1], None, .1),
+            Pab1Reactivation("disagg", [iPab1, C], [Pab1, C], None, .1),
+            CProduction("C Translation", [Pab1], [C], None, 1),
+            UniDeg("C Degradation", [C], [], None, .1)]
+    net = Network([Pab1, C, iPab1], rxns)
+    return lambda: {"events": _events(net.simulate(0, 10, [(0, 1)], None,
+                                                   method=method, seed=1), 2)}
+
+
+def pab1e3(method):
+    return pab_translation(1e3, method)
+
+
+def pab1e4(method):
+    return pab_translation(1e4, method)
+
+
+def pab1e5(method):
+    return pab_translation(1e5, method)
+
+
+def ode_v5(method):
+    """ODE-v5.py: the heat shock from 10 to 20 min, with the generated
+    Jacobian."""
+    from odedriver import integrate
+    from pabmodels import pab1_v5
+    model = pab1_v5(13000).compile()
+    deriv, jac = _Counted(model.deriv), _Counted(model.jac)
+    zinit = np.array([13000, 0, 28591, 5, 0])
+
+    def run():
+        integrate(deriv, zinit, 0, 100., [(0, 303), (10., 317), (20., 303)],
+                  jac=jac, method=method)
+        return {"rhs_evals": deriv.calls, "jac_evals": jac.calls}
+    return run
+
+
+def _zheng_deriv(z, t):
+    """deriv of zheng-2016.py, with its parameters."""
+    k1 = k3 = 166.8
+    k2, k4, k5 = 2.783, 0.0464, 4.64e-7
+    beta, Kd, kdil, n = 1.778, 0.0022, 0, 3
+    HSP, HSF1, HSP_HSF1, HSP_UP, UP, YFP = z
+    act = beta*(HSF1**n/(Kd**n + HSF1**n))
+    dHSPdt = k2*HSP_HSF1 - k1*HSP*HSF1 + (k4 + k5)*HSP_UP - k3*HSP*UP + act
+    dHSF1dt = k2*HSP_HSF1 - k1*HSP*HSF1
+    dHSP_UPdt = -(k4 + k5)*HSP_UP + k3*HSP*UP
+    dUPdt = k4*HSP_UP - k3*HSP*UP
+    return np.array([dHSPdt, dHSF1dt, -dHSF1dt, dHSP_UPdt, dUPdt, act - kdil*YFP])
+
+
+def zheng_2016(method):
+    """zheng-2016.py: the timecourses at its five temperatures."""
+    from odedriver import integrate
+    deriv = _Counted(_zheng_deriv)
+
+    def run():
+        for T in [37, 39, 40, 42, 45]:
+            zinit = np.array([1, 0, 1/500., 0, 0.0024*np.exp(0.215*T), 3])
+            integrate(deriv, zinit, 0, 200, None, method=method).sample(np.arange(0, 200, 0.1))
+        return {"rhs_evals": deriv.calls}
+    return run
+
+
+def _peak_rss():
+    """Peak resident memory of this process in MB."""
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/2.**20 if sys.platform == "darwin" else rss/2.**10
+
+
+def _timed(build, method):
+    """Build a workload and time one run; return (seconds, counts)."""
+    run = build(method)
+    start = time.time()
+    counts = run()
+    return time.time() - start, counts
+
+
+def _measure(name, method, repeat, min_time):
+    """Measure workload name (in a fresh process): a first run to warm up
+    and size the rounds, then repeat rounds of at least min_time seconds.
+    Returns its metrics."""
+    import resultcache
+    os.environ.pop("AGG_SIM_CACHE", None)
+    resultcache.disable()
+    build = globals()[name]
+    stdout = sys.stdout
+    walls = []
+    try:
+        # the SSA loops report their progress
+        sys.stdout = open(os.devnull, "w")
+        first, counts = _timed(build, method)
+        runs = max(1, int(np.ceil(min_time/max(first, 1e-6))))
+        for i in range(repeat):
+            walls.append(sum(_timed(build, method)[0] for k in range(runs))/runs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    out = dict(counts, method=method, runs=runs, wall=min(walls),
+               peak_rss_mb=_peak_rss())
+    if "events" in out:
+        out["events_per_s"] = out["events"]/out["wall"]
+    return out
+
+
+def run(names=None, ssa_method="python", ode_method="LSODA", repeat=3,
+        min_time=1.):
+    """Measure the workloads (default all), the SSA ones with the
+    Network.simulate method ssa_method and the ODE ones with the solve_ivp
+    method ode_method; return the results, with a description of the
+    machine, as a JSON-serialisable dict. A workload which fails is kept
+    as its error, and the others still run."""
+    results = {}
+    for name in names or WORKLOADS:
+        if name not in WORKLOADS:
+            raise ValueError("Unknown workload: %s" % name)
+        method = ode_method if name in ODE_WORKLOADS else ssa_method
+        pool = multiprocessing.Pool(1)
+        try:
+            results[name] = pool.apply(_measure, (name, method, repeat, min_time))
+        except Exception as e:
+            results[name] = {"method": method, "error": "%s: %s" % (type(e).__name__, e)}
+        finally:
+            pool.close()
+            pool.join()
+    return {"python": platform.python_version(), "numpy": np.__version__,
+            "machine": platform.platform(), "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "results": results}
+
+
+def compare(current, baseline, tolerance=0.1):
+    """Compare two results of run workload by workload; return a list of
+    (workload, metric, baseline, current) for regressions: wall time or
+    peak memory more than tolerance above the baseline, or events per
+    second more than tolerance below it. ODE evaluation counts are
+    deterministic, so any increase is reported."""
+    regressions = []
+    for name, cur in sorted(current["results"].items()):
+        base = baseline["results"].get(name)
+        if base is None or base.get("method") != cur.get("method"):
+            continue
+        for metric in ("wall", "peak_rss_mb", "rhs_evals", "jac_evals"):
+            if metric in cur and metric in base:
+                limit = base[metric] if metric.endswith("evals") else base[metric]*(1 + tolerance)
+                if cur[metric] > limit:
+                    regressions.append((name, metric, base[metric], cur[metric]))
+        if "events_per_s" in cur and "events_per_s" in base and \
+           cur["events_per_s"] < base["events_per_s"]*(1 - tolerance):
+            regressions.append((name, "events_per_s", base["events_per_s"],
+                                cur["events_per_s"]))
+    return regressions
+
+
+def report(current, baseline=None):
+    """Table of the results, with the ratio of each to the baseline."""
+    metrics = ["wall", "events", "events_per_s", "rhs_evals", "jac_evals", "peak_rss_mb"]
+    lines = ["%-16s %-8s" % ("workload", "method") +
+             "".join("%19s" % m for m in metrics)]
+    for name, cur in sorted(current["results"].items()):
+        base = (baseline or {}).get("results", {}).get(name, {})
+        cells = []
+        for m in metrics:
+            if m not in cur:
+                cells.append("%19s" % "-")
+            elif base.get(m):
+                cells.append("%19s" % ("%.4g (x%.2f)" % (cur[m], cur[m]/float(base[m]))))
+            else:
+                cells.append("%19s" % ("%.4g" % cur[m]))
+        if "error" in cur:
+            cells = ["  failed: %s" % cur["error"]]
+        lines.append("%-16s %-8s" % (name, cur["method"]) + "".join(cells))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("workloads", nargs="*", help="of %s" % ", ".join(WORKLOADS))
+    parser.add_argument("--ssa-method", default="python",
+                        help="Network.simulate method (python, array, compiled, ...)")
+    parser.add_argument("--ode-method", default="LSODA",
+                        help="solve_ivp method for the ODE workloads")
+    parser.add_argument("--repeat", type=int, default=3, help="rounds per workload")
+    parser.add_argument("--min-time", type=float, default=1.,
+                        help="seconds of runs in each round")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of baseline results")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+    current = run(args.workloads, args.ssa_method, args.ode_method, args.repeat,
+                  args.min_time)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print(report(current, baseline))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+    if baseline is not None:
+        regressions = compare(current, baseline, args.tolerance)
+        for name, metric, base, cur in regressions:
+            print("Regression in %s: %s %.4g -> %.4g" % (name, metric, base, cur))
+        if regressions:
+            sys.exit(1)
+    if any("error" in r for r in current["results"].values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
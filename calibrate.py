@@ -0,0 +1,228 @@
+#!/usr/bin/python
+"""
+Fitting netspec models to measured timecourses.
+
+The rate constants of the ODE scripts are tuned by editing literals and
+rerunning. A Calibration fits named parameters of a netspec Model (see
+Model.with_parameters: rate constants, rate law parameters such as Ea,
+initial amounts) to one or more Experiments, each a temperature schedule
+with measured species at given times, by bounded least squares or, with
+several starts, from random points within the bounds:
+
+    cal = Calibration(pab1_v5(), [Experiment(times, counts, ["C"],
+                                             [(0, 303), (10, 317)])],
+                      [("deactivation", 1e-4, 1.), ("deactivation.Ea", 0, 300)])
+    fit = cal.fit(starts=8, seed=1)
+    fit.params          # {"deactivation": ..., "deactivation.Ea": ...}
+
+Parameters with a positive lower bound are fitted on a log scale. Solved
+trajectories are memoized in an LRUCache keyed by the parameter vector, so
+an optimiser returning to a point (line searches, the base point of
+finite-difference gradients, restarts) does not solve it again. When every
+parameter is a rate constant, the gradients come from one forward
+sensitivity solve (see sensitivity.py) instead of finite differences.
+"""
+
+import numpy as np
+from scipy.optimize import least_squares, minimize
+from odedriver import integrate
+from ratelaw import LRUCache
+from sensitivity import sensitivities
+
+_LEAST_SQUARES = ("trf", "dogbox", "lm")
+# errors of a solve at a bad parameter point, which give that point large
+# residuals; others (a model with rate laws run without temp_fxn, say) are
+# mistakes in the setup and propagate
+_SOLVE_ERRORS = (RuntimeError, ArithmeticError, ValueError, np.linalg.LinAlgError)
+_GRADIENT_METHODS = ("CG", "BFGS", "L-BFGS-B", "TNC", "SLSQP", "TRUST-CONSTR")
+
+
+class Experiment(object):
+    """Measured species (columns of observed) at times, under temp_fxn
+    (None for a model without rate laws), starting from initial (default
+    the model's initial amounts). sigma scales the residuals: a number or
+    an array like observed."""
+    def __init__(self, times, observed, species, temp_fxn=None, initial=None,
+                 sigma=1.):
+        self.times = np.asarray(times, dtype=float)
+        self.observed = np.asarray(observed, dtype=float).reshape(len(self.times), -1)
+        self.species = list(species)
+        self.temp_fxn = temp_fxn
+        self.initial = initial
+        self.sigma = sigma
+
+
+class FitResult(object):
+    """Best parameters (params by name, theta as a vector) and cost of a
+    fit, the optimiser results of every start, and the numbers of
+    objective calls and of ODE solves they needed."""
+    def __init__(self, names, theta, cost, runs, calls, solves):
+        self.names = names
+        self.theta = theta
+        self.params = dict(zip(names, theta))
+        self.cost = cost
+        self.runs = runs
+        self.success = any(r.success for r in runs)
+        self.calls = calls
+        self.solves = solves
+
+
+class Calibration(object):
+    """Fit the parameters [(name, lower, upper), ...] of a Model to a list
+    of Experiments. Options (method, rtol, atol, ...) go to
+    odedriver.integrate."""
+    def __init__(self, model, experiments, parameters, t_start=0.,
+                 cache_size=256, rtol=1e-8, atol=1e-8, **options):
+        self.model = model
+        self.experiments = experiments
+        self.names = [p[0] for p in parameters]
+        self.lower = np.array([p[1] for p in parameters], dtype=float)
+        self.upper = np.array([p[2] for p in parameters], dtype=float)
+        self.log = self.lower > 0
+        self.t_start = t_start
+        self.options = dict(options, rtol=rtol, atol=atol)
+        self._solutions = LRUCache(cache_size)
+        self._gradients = LRUCache(cache_size)
+        reactions = [r.name for r in model.reactions]
+        rates = [n[:-len(".rate")] if n.endswith(".rate") else n for n in self.names]
+        self.rates = rates if all(r in reactions for r in rates) else None
+        self.calls = 0
+        self.solves = 0
+
+    def initial_guess(self):
+        """The model's current values of the parameters."""
+        return np.array([self.model.parameter(n) for n in self.names], dtype=float)
+
+    def to_x(self, theta):
+        """Map parameters to the optimiser's (partly logarithmic) scale."""
+        theta = np.array(theta, dtype=float)
+        theta[self.log] = np.log(theta[self.log])
+        return theta
+
+    def to_theta(self, x):
+        theta = np.array(x, dtype=float)
+        theta[self.log] = np.exp(theta[self.log])
+        return theta
+
+    def simulate(self, theta):
+        """Return the simulated observables of each experiment at theta
+        (None for an experiment that failed to integrate)."""
+        self.calls += 1
+        key = np.asarray(theta, dtype=float).tobytes()
+        return self._solutions.get(key, self._simulate)
+
+    def _simulate(self, key):
+        self.solves += 1
+        theta = np.frombuffer(key)
+        compiled = self._compiled(theta)
+        out = []
+        for ex in self.experiments:
+            z0 = compiled.initial if ex.initial is None else ex.initial
+            cols = [compiled.names.index(s) for s in ex.species]
+            try:
+                course = integrate(compiled, z0, self.t_start, ex.times[-1],
+                                   ex.temp_fxn, **self.options)
+            except _SOLVE_ERRORS:
+                out.append(None)
+                continue
+            out.append(course.sample(ex.times)[:, cols])
+        return out
+
+    def _compiled(self, theta):
+        return self.model.with_parameters(dict(zip(self.names, theta))).compile()
+
+    def gradients(self, theta):
+        """Return the Jacobian of the residuals at theta, from forward
+        sensitivities (only if every parameter is a rate constant)."""
+        key = np.asarray(theta, dtype=float).tobytes()
+        return self._gradients.get(key, self._sensitivities)
+
+    def _sensitivities(self, key):
+        self.solves += 1
+        theta = np.frombuffer(key)
+        compiled = self._compiled(theta)
+        out, sims = [], []
+        for ex in self.experiments:
+            z0 = compiled.initial if ex.initial is None else ex.initial
+            cols = [compiled.names.index(s) for s in ex.species]
+            try:
+                sens = sensitivities(compiled, z0, self.t_start, ex.times[-1],
+                                     ex.temp_fxn, self.rates, **self.options)
+            except _SOLVE_ERRORS:
+                out.append(np.zeros((ex.observed.size, len(theta))))
+                sims.append(None)
+                continue
+            sigma = np.broadcast_to(ex.sigma, ex.observed.shape)[:, :, None]
+            out.append((sens(ex.times)[:, cols, :]/sigma).reshape(-1, len(theta)))
+            sims.append(sens.state(ex.times)[:, cols])
+        # the sensitivity run also gives the solution at theta
+        self._solutions.get(key, lambda key: sims)
+        return np.vstack(out)
+
+    def residuals(self, theta):
+        """Weighted residuals of all experiments at theta; a failed
+        integration gives large residuals instead."""
+        res = []
+        for ex, sim in zip(self.experiments, self.simulate(theta)):
+            if sim is None:
+                res.append(np.full(ex.observed.size, 1e10))
+            else:
+                res.append(((sim - ex.observed)/ex.sigma).ravel())
+        return np.concatenate(res)
+
+    def cost(self, theta):
+        r = self.residuals(theta)
+        return .5*r.dot(r)
+
+    def _residual_jac(self, x):
+        """Jacobian of the residuals in the optimiser's scale."""
+        theta = self.to_theta(x)
+        return self.gradients(theta)*np.where(self.log, theta, 1.)
+
+    def _cost_gradient(self, x):
+        theta = self.to_theta(x)
+        return self._residual_jac(x).T.dot(self.residuals(theta))
+
+    def _starts(self, x0, starts, rng):
+        lo, hi = self.to_x(self.lower), self.to_x(self.upper)
+        points = [x0]
+        for k in range(starts - 1):
+            finite = np.isfinite(lo) & np.isfinite(hi)
+            x = x0 + rng.normal(size=len(x0))
+            x[finite] = rng.uniform(lo[finite], hi[finite])
+            points.append(np.clip(x, lo, hi))
+        return points
+
+    def fit(self, theta0=None, starts=1, seed=None, method="trf", **options):
+        """Fit from theta0 (default the model's values) and starts - 1
+        random points within the bounds; return the best as a FitResult.
+
+        method "trf", "dogbox" or "lm" runs scipy's least_squares on the
+        residuals, any other a scipy.optimize.minimize method on the cost.
+        options go to the optimiser; unless they give jac, the sensitivity
+        gradients are used where available (for minimize, with the methods
+        using gradients).
+        """
+        theta0 = self.initial_guess() if theta0 is None else np.asarray(theta0, dtype=float)
+        lo, hi = self.to_x(self.lower), self.to_x(self.upper)
+        rng = np.random.RandomState(seed)
+        calls, solves = self.calls, self.solves
+        runs = []
+        if self.rates is not None and "jac" not in options:
+            if method in _LEAST_SQUARES:
+                options["jac"] = self._residual_jac
+            elif method.upper() in _GRADIENT_METHODS:
+                options["jac"] = self._cost_gradient
+        for x0 in self._starts(self.to_x(theta0), starts, rng):
+            if method in _LEAST_SQUARES:
+                bounds = (lo, hi) if method != "lm" else (-np.inf, np.inf)
+                run = least_squares(lambda x: self.residuals(self.to_theta(x)), x0,
+                                    bounds=bounds, method=method, **options)
+            else:
+                run = minimize(lambda x: self.cost(self.to_theta(x)), x0,
+                               method=method, bounds=list(zip(lo, hi)), **options)
+                run.cost = run.fun
+            runs.append(run)
+        best = min(runs, key=lambda r: r.cost)
+        return FitResult(self.names, self.to_theta(best.x), best.cost, runs,
+                         self.calls - calls, self.solves - solves)
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+"""
+Continuation of steady states in a parameter.
+
+par.py finds the threshold of its positive autoregulation loop by
+integrating hundreds of nearby initial conditions. continuation instead
+follows a branch of equilibria of deriv(z, t, p) as the parameter p varies,
+by pseudo-arclength continuation (an Euler predictor along the branch's
+tangent and Newton corrections back onto it), so the branch can be traced
+around saddle-node folds, where two equilibria meet and vanish. Each point
+is classified as stable or not from the eigenvalues of the Jacobian, and
+folds are located by bisection on the sign of dp/ds.
+
+    def deriv_beta(z, t, beta):
+        return beta*z**n/(K**n + z**n) - k_deg*z
+
+    branch = continuation(deriv_beta, [2.], 3., 0., 5., direction=-1)
+    branch.folds        # [(2.0, array([1.]))]: beta_max below which X dies
+
+For a netspec.CompiledModel p is the temperature T, and its conservation
+laws are held fixed at the totals of the starting state (see steady.py).
+"""
+
+import numpy as np
+from scipy.linalg import eigvals, null_space, solve
+from steady import SteadyStateProblem, _steady_state
+
+
+class Branch(object):
+    """A traced branch: parameter values p, states z (points, species),
+    stability (all eigenvalues with negative real part) and the largest
+    real part of the eigenvalues, and the folds as (p, z) pairs."""
+    def __init__(self, p, z, stable, growth, folds):
+        self.p = np.array(p)
+        self.z = np.array(z)
+        self.stable = np.array(stable, dtype=bool)
+        self.growth = np.array(growth)
+        self.folds = folds
+
+    def __len__(self):
+        return len(self.p)
+
+
+class _Continuation(object):
+    """The steady-state equations in the scaled unknowns u = (z/scale, p)."""
+    def __init__(self, problem, totals, scale):
+        self.problem = problem
+        self.totals = totals
+        self.scale = scale
+        n = len(scale)
+        # basis of the states allowed by the conservation laws
+        self.Q = null_space(problem.L) if len(problem.L) else np.eye(n)
+
+    def residual(self, u):
+        self.problem.T = u[-1]
+        return self.problem.residual(u[:-1]*self.scale, self.totals)
+
+    def state_jac(self, z, p):
+        self.problem.T = p
+        if self.problem.jac is not None:
+            return np.array(self.problem.jac(z, 0., p), dtype=float)
+        f0 = np.asarray(self.problem.deriv(z, 0., p), dtype=float)
+        J = np.empty((len(z), len(z)))
+        for i in range(len(z)):
+            h = 1e-7*max(abs(z[i]), 1.)
+            dz = z.copy()
+            dz[i] += h
+            J[:, i] = (np.asarray(self.problem.deriv(dz, 0., p)) - f0)/h
+        return J
+
+    def jacobian(self, u):
+        """Return dF/du, (species, species + 1)."""
+        z, p = u[:-1]*self.scale, u[-1]
+        J = self.state_jac(z, p)
+        if len(self.problem.pivots):
+            J[self.problem.pivots] = self.problem.L
+        h = 1e-6*max(abs(p), 1.)
+        up, down = u.copy(), u.copy()
+        up[-1] += h
+        down[-1] -= h
+        dp = (self.residual(up) - self.residual(down))/(2*h)
+        return np.column_stack([J*self.scale, dp])
+
+    def tangent(self, u, previous):
+        """Unit tangent of the branch at u, oriented along previous."""
+        A = np.vstack([self.jacobian(u), previous])
+        t = solve(A, np.r_[np.zeros(len(u) - 1), 1.])
+        return t/np.linalg.norm(t)
+
+    def correct(self, u0, t0, s, tol=1e-10, max_iter=20):
+        """Newton correction of the point at arclength s along t0 from u0
+        back onto the branch, holding t0.(u - u0) = s. Returns None if
+        Newton does not converge."""
+        u = u0 + s*t0
+        for i in range(max_iter):
+            R = np.r_[self.residual(u), t0.dot(u - u0) - s]
+            du = solve(np.vstack([self.jacobian(u), t0]), -R)
+            u = u + du
+            if not np.all(np.isfinite(u)):
+                return None
+            if np.linalg.norm(du) < tol*(1. + np.linalg.norm(u)):
+                return u
+        return None
+
+    def rescale(self, u, t):
+        """Rescale to the state at u, so that steps stay relative as the
+        species change by orders of magnitude along the branch."""
+        z = u[:-1]*self.scale
+        scale = np.maximum(np.abs(z), 1.)
+        t = np.r_[t[:-1]*self.scale/scale, t[-1]]
+        self.scale = scale
+        return np.r_[z/scale, u[-1]], t/np.linalg.norm(t)
+
+    def stability(self, u):
+        """Return the largest real part of the eigenvalues of the Jacobian
+        on the states with the conserved totals."""
+        z, p = u[:-1]*self.scale, u[-1]
+        J = self.Q.T.dot(self.state_jac(z, p)).dot(self.Q)
+        return np.max(eigvals(J).real) if len(J) else -np.inf
+
+
+def continuation(deriv, z0, p0, p_min, p_max, direction=1, jac=None,
+                 conserved=None, ds=0.01, ds_min=1e-8, ds_max=1.,
+                 max_points=2000):
+    """Trace the branch of equilibria of deriv(z, t, p) through the steady
+    state reached from z0 at p0, while p stays in [p_min, p_max].
+
+    direction=1 starts towards larger p, -1 towards smaller. deriv may be a
+    netspec.CompiledModel (p is then T); jac(z, t, p) and the conserved
+    laws are as for steady.steady_state. ds, ds_min and ds_max are
+    arclength steps in p and the species relative to their current values.
+    Returns a Branch.
+    """
+    problem = SteadyStateProblem(deriv, p0, jac, conserved)
+    z0 = np.asarray(z0, dtype=float)
+    z = _steady_state(problem, z0)
+    scale = np.maximum(np.abs(z), 1.)
+    cont = _Continuation(problem, problem.totals(z0), scale)
+    u = np.r_[z/scale, p0]
+    t = cont.tangent(u, np.r_[np.zeros(len(z)), float(direction)])
+    points, growth, folds = [np.r_[z, p0]], [cont.stability(u)], []
+    while len(points) < max_points and p_min <= u[-1] <= p_max:
+        u_new = cont.correct(u, t, ds)
+        t_new = None if u_new is None else cont.tangent(u_new, t)
+        # a step which bends the branch sharply may have jumped to another
+        if t_new is None or t_new.dot(t) < .95 or \
+           np.linalg.norm(u_new - u - ds*t) > .2*ds:
+            ds /= 2.
+            if ds < ds_min:
+                break
+            continue
+        if t_new[-1]*t[-1] < 0:
+            folds.append(_fold(cont, u, t, ds))
+        u, t = cont.rescale(u_new, t_new)
+        points.append(np.r_[u[:-1]*cont.scale, u[-1]])
+        growth.append(cont.stability(u))
+        ds = min(ds*1.5, ds_max)
+    U = np.array(points)
+    growth = np.array(growth)
+    return Branch(U[:, -1], U[:, :-1], growth < 0, growth, folds)
+
+
+def _fold(cont, u, t, ds, tol=1e-12):
+    """Locate the fold between u and the point ds further along t, where
+    the p component of the tangent changes sign."""
+    lo, hi = 0., ds
+    fold = u
+    while hi - lo > tol*max(ds, 1.):
+        mid = (lo + hi)/2.
+        v = cont.correct(u, t, mid)
+        if v is None:
+            break
+        fold = v
+        if cont.tangent(v, t)[-1]*t[-1] > 0:
+            lo = mid
+        else:
+            hi = mid
+    return fold[-1], fold[:-1]*cont.scale
@@ -0,0 +1,241 @@
+#!/usr/bin/python
+"""
+Global sensitivity analysis of model outputs over parameter ranges.
+
+Forward sensitivities (sensitivity.py) answer which parameter matters near
+one point; the analyses here ask which drive an output, such as the
+chaperone peak, across the whole plausible range of the parameters
+(Peak and ModelBuild are from sweep.py):
+
+    space = Space([("deactivation", 1e-3, 1e-1), ("transcription", 1e-2, 1.),
+                   ("deactivation.Ea", 40., 160.)])
+    sobol = Sobol(space, ModelBuild(pab1_v4(), [(0, 303), (10, 317), (20, 303)]),
+                  Peak("C"), 180.)
+    sobol.run(1024)                  # 1024*(d + 2) model runs
+    sobol.first, sobol.total         # Saltelli/Jansen estimates so far
+    sobol.run(1024)                  # refine without resampling
+
+Morris screens with r one-at-a-time trajectories (r*(d + 1) runs) for the
+parameters that matter at all; Sobol estimates first-order and total
+indices from a Saltelli design, drawing its base samples from a Sobol
+sequence (scipy.stats.qmc) or by Latin hypercube. Both keep running sums,
+so run can be called again to add samples and the standard errors show
+whether the estimates have converged. Model runs go through
+sweep.evaluate on a process pool; by default each run ends at steady
+state after the last temperature change, which most of them reach well
+before t_end.
+"""
+
+import numpy as np
+from odedriver import SteadyState
+from sweep import evaluate
+
+
+class Space(object):
+    """Parameters [(name, lower, upper), ...], log-uniform where the lower
+    bound is positive and uniform otherwise."""
+    def __init__(self, parameters):
+        self.names = [p[0] for p in parameters]
+        self.lower = np.array([p[1] for p in parameters], dtype=float)
+        self.upper = np.array([p[2] for p in parameters], dtype=float)
+        self.log = self.lower > 0
+
+    def __len__(self):
+        return len(self.names)
+
+    def values(self, unit):
+        """Map points of the unit cube (rows) to parameter values."""
+        unit = np.atleast_2d(unit)
+        lo = np.where(self.log, np.log(np.where(self.log, self.lower, 1.)), self.lower)
+        hi = np.where(self.log, np.log(np.where(self.log, self.upper, 1.)), self.upper)
+        x = lo + unit*(hi - lo)
+        return np.where(self.log, np.exp(x), x)
+
+    def points(self, unit):
+        """Point dicts for the rows of unit."""
+        return [dict(zip(self.names, v)) for v in self.values(unit)]
+
+
+def latin_hypercube(n, d, rng):
+    """n points of a Latin hypercube in [0, 1)^d."""
+    cells = np.array([rng.permutation(n) for i in range(d)]).T
+    return (cells + rng.uniform(size=(n, d)))/n
+
+
+class _Sums(object):
+    """Running sum and sum of squares of the terms of a mean."""
+    def __init__(self):
+        self.n = 0
+        self.s = 0.
+        self.ss = 0.
+
+    def add(self, terms):
+        self.n += len(terms)
+        self.s = self.s + terms.sum(axis=0)
+        self.ss = self.ss + (terms**2).sum(axis=0)
+
+    def mean(self):
+        return self.s/self.n
+
+    def error(self):
+        """Standard error of the mean."""
+        var = self.ss/self.n - self.mean()**2
+        return np.sqrt(np.maximum(var, 0.)/self.n)
+
+
+class _Analysis(object):
+    def __init__(self, space, build, output, t_end, t_start=0., seed=None,
+                 steady=True, workers=None, chunksize=16, **options):
+        self.space = space
+        self.build = build
+        self.output = output
+        self.t_start = t_start
+        self.t_end = t_end
+        self.rng = np.random.RandomState(seed)
+        self.seed = seed
+        self.steady = SteadyState() if steady is True else (steady or None)
+        self.workers = workers
+        self.chunksize = chunksize
+        self.options = options
+        self.runs = 0
+        self.failed = 0
+
+    def _evaluate(self, unit):
+        """Output at the rows of unit, flattened to (rows, outputs)."""
+        arrays, failed = evaluate(self.build, self.space.points(unit), [self.output],
+                                  self.t_end, self.t_start, self.workers,
+                                  self.chunksize, self.steady, **self.options)
+        self.runs += len(unit)
+        self.failed += int(failed.sum())
+        return arrays[0].reshape(len(unit), -1)
+
+
+class Morris(_Analysis):
+    """Morris elementary-effects screening.
+
+    After run(r), mu_star is the mean absolute elementary effect of each
+    parameter (with its standard error mu_star_error), mu the mean and
+    sigma the standard deviation, per output component (columns). Effects
+    are differences of the output over steps of delta in the unit cube.
+    """
+    def __init__(self, space, build, output, t_end, levels=4, **options):
+        _Analysis.__init__(self, space, build, output, t_end, **options)
+        self.levels = levels
+        self.delta = levels/(2.*(levels - 1))
+        self._effects = None
+        self._abs = None
+
+    def trajectories(self, r):
+        """r trajectories of d + 1 points, each changing one parameter."""
+        d = len(self.space)
+        grid = np.arange(self.levels)/(self.levels - 1.)
+        starts = grid[grid <= 1 - self.delta + 1e-12]
+        out = np.empty((r, d + 1, d))
+        for k in range(r):
+            x = self.rng.choice(starts, d)
+            out[k, 0] = x
+            for step, i in enumerate(self.rng.permutation(d)):
+                x = x.copy()
+                x[i] += self.delta
+                out[k, step + 1] = x
+        return out
+
+    def run(self, r):
+        d = len(self.space)
+        traj = self.trajectories(r)
+        Y = self._evaluate(traj.reshape(-1, d)).reshape(r, d + 1, -1)
+        # the parameter changed at each step is where the points differ
+        changed = np.argmax(np.diff(traj, axis=1) != 0, axis=2)
+        effects = np.empty((r, d, Y.shape[2]))
+        for k in range(r):
+            effects[k, changed[k]] = (Y[k, 1:] - Y[k, :-1])/self.delta
+        effects = effects[np.all(np.isfinite(effects), axis=(1, 2))]
+        if self._effects is None:
+            self._effects, self._abs = _Sums(), _Sums()
+        self._effects.add(effects)
+        self._abs.add(np.abs(effects))
+        return self
+
+    @property
+    def mu(self):
+        return self._effects.mean()
+
+    @property
+    def mu_star(self):
+        return self._abs.mean()
+
+    @property
+    def mu_star_error(self):
+        return self._abs.error()
+
+    @property
+    def sigma(self):
+        n = self._effects.n
+        var = self._effects.ss/n - self.mu**2
+        return np.sqrt(np.maximum(var, 0.)*n/max(n - 1, 1))
+
+
+class Sobol(_Analysis):
+    """Variance-based (Sobol) indices from a Saltelli design.
+
+    Each of the N base samples runs the model at two independent points A
+    and B and at the d points AB_i (A with parameter i from B). After run,
+    first holds the first-order indices (Saltelli 2010), total the total
+    indices (Jansen), and first_error and total_error their standard
+    errors, per parameter (rows) and output component (columns).
+    sampling is "sobol" or "lhs".
+    """
+    def __init__(self, space, build, output, t_end, sampling="sobol", **options):
+        _Analysis.__init__(self, space, build, output, t_end, **options)
+        self.sampling = sampling
+        self._sequence = None
+        self._first = _Sums()
+        self._total = _Sums()
+        self._f = _Sums()
+
+    def base_samples(self, n):
+        """The next n rows of [A | B] in [0, 1)^(2d)."""
+        d2 = 2*len(self.space)
+        if self.sampling == "lhs":
+            return latin_hypercube(n, d2, self.rng)
+        if self._sequence is None:
+            from scipy.stats import qmc
+            self._sequence = qmc.Sobol(d2, scramble=True, seed=self.seed)
+        return self._sequence.random(n)
+
+    def run(self, n):
+        d = len(self.space)
+        AB = self.base_samples(n)
+        A, B = AB[:, :d], AB[:, d:]
+        mixed = np.repeat(A[:, None, :], d, axis=1)
+        mixed[:, np.arange(d), np.arange(d)] = B
+        design = np.concatenate([A, B, mixed.reshape(-1, d)])
+        Y = self._evaluate(design)
+        fA, fB, fAB = Y[:n], Y[n:2*n], Y[2*n:].reshape(n, d, -1)
+        ok = np.isfinite(fA).all(axis=1) & np.isfinite(fB).all(axis=1) & \
+            np.isfinite(fAB).all(axis=(1, 2))
+        fA, fB, fAB = fA[ok], fB[ok], fAB[ok]
+        self._f.add(np.concatenate([fA, fB]))
+        self._first.add(fB[:, None, :]*(fAB - fA[:, None, :]))
+        self._total.add(.5*(fA[:, None, :] - fAB)**2)
+        return self
+
+    @property
+    def variance(self):
+        return self._f.ss/self._f.n - self._f.mean()**2
+
+    @property
+    def first(self):
+        return self._first.mean()/self.variance
+
+    @property
+    def total(self):
+        return self._total.mean()/self.variance
+
+    @property
+    def first_error(self):
+        return self._first.error()/self.variance
+
+    @property
+    def total_error(self):
+        return self._total.error()/self.variance
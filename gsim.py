@@ -3,8 +3,15 @@
 Basic implementation of the Gillespie algorithm.
 """
 
+import math
 import numpy as np
 import matplotlib.pyplot as plt
+from gsim_array import ArrayNetwork, ARRAY_METHODS
+from gsim_compile import compile_network
+from gsim_ensemble import simulate_ensemble
+from gsim_random import RandomBlock
+from gsim_record import read_trajectory, recorder
+import resultcache
 
 class Species(object):
     """A chemical species. Has the inherent properties name and count."""
@@ -35,11 +42,19 @@ class Reaction(object):
         self.op = op
         
     def prop(self):
+        """rate*x*(x - 1)*... for a reactant listed more than once, so that
+        it cannot fire with fewer molecules than it consumes."""
         alpha = self.rate
+        seen = []
         for i in self.ip:
-            alpha *= i.count
+            alpha *= i.count - seen.count(i)
+            seen.append(i)
         return alpha
         
+    def mass_action(self):
+        """Describe prop as (rate, reactants) for the array engine."""
+        return self.rate, list(self.ip)
+        
 #    def perform(self):
 #        pass
         
@@ -51,6 +66,9 @@ class ConstInduction(Reaction):
     def prop(self):
         return self.rate
         
+    def mass_action(self):
+        return self.rate, []
+        
     def perform(self):
         self.op[0].produce()
         
@@ -77,62 +95,123 @@ class Network(object):
         self.species = sp_list
         self.reactions = rxn_list
         
-    def simulate(self, t_start, t_end, filename):
+    def arrays(self):
+        """Return the network compiled to arrays (see gsim_array)."""
+        return ArrayNetwork(self.species, self.reactions)
+        
+    def compile(self):
+        """Return the network with a generated simulation loop (see
+        gsim_compile)."""
+        return compile_network(self)
+        
+    def simulate(self, t_start, t_end, filename, method="python", times=None,
+                 seed=None, block=True, **options):
         """Implementation of the Gillespie SSA.
         
         No check on runtime. Make sure to double check rate/times so that
-        simulation doesn't get out of control. filename should be a string.
+        simulation doesn't get out of control. filename should be a string;
+        unless it is None (or "None") the trajectory is streamed to it in
+        the binary format of gsim_record as the run goes, and the returned
+        array is a memory-mapped view of the file (see output_parser).
+        seed, if given, seeds the random numbers and is kept in the header.
+        With block=True random numbers are drawn in vectorised blocks (see
+        gsim_random); the trajectory is the same as with scalar draws.
+        method="array" runs the same algorithm on the network compiled to
+        NumPy arrays (see gsim_array), which avoids the per-reaction method
+        calls for large copy numbers; method="next-reaction" uses the
+        Gibson-Bruck next reaction method on the array form, which only
+        recomputes the propensities affected by each firing;
+        method="tau-leap" uses adaptive tau-leaping for large copy numbers;
+        method="hybrid" integrates the reactions among abundant species as
+        ODEs between stochastic firings of the rest (see gsim_hybrid);
+        method="compiled" runs the python loop as one generated function
+        with the propensities and updates inlined (see gsim_compile).
+        Extra keyword options are passed on to the array engine.
+        Events are recorded into preallocated buffers; if times is given
+        only the state holding at each of those times is kept instead.
+        Seeded runs not streamed to a file are looked up in the active
+        resultcache, if there is one.
         """
+        args = (t_start, t_end, filename, method, times, seed, block, options)
+        if seed is not None and filename in (None, "None") and resultcache.active() is not None:
+            return resultcache.cached_simulation(self, self._simulate, args)
+        return self._simulate(*args)
+
+    def _simulate(self, t_start, t_end, filename, method, times, seed, block,
+                  options):
         assert t_start < t_end
+        if method in ARRAY_METHODS:
+            return self.arrays().simulate(t_start, t_end,
+                                          method=ARRAY_METHODS[method], times=times,
+                                          filename=filename, seed=seed, block=block,
+                                          **options)
+        elif method == "compiled":
+            return self.compile().simulate(t_start, t_end, times=times,
+                                           filename=filename, seed=seed,
+                                           block=block)
+        elif method != "python":
+            raise ValueError("Unknown simulation method: %s" % method)
         t = t_start
         n_steps = 0
-        time = [[t]]
-        data = [[i.count for i in self.species]]
-        while t <= t_end:
-            r1, r2 = np.random.uniform(), np.random.uniform()
-            alpha_vec = [i.prop() for i in self.reactions]
-            alpha = np.sum(alpha_vec)
-            try:
-                tau = 1./alpha*np.log(1./r1)
-            except ZeroDivisionError:
-                print "Propensity equal to zero at step = %d, time = %d;\
-                Simulation terminated." % (n_steps, t)
-                break
-
-            t = t + tau
-            n_steps += 1
-            #update species; there is definitely a better/faster way to do this
-            #also find a way to ensure that a reaction happens at every time step
-            #lead -> no two rows in the final array should be the same except time
-            z = 0
-            for i in range(len(alpha_vec)):
-                z += alpha_vec[i]
-                if float(z)/alpha == 1.0:
-                    self.reactions[i].perform()
-                    #print self.reactions[i].name
+        if seed is not None:
+            np.random.seed(seed)
+        draws = RandomBlock() if block else np.random
+        record = recorder(len(self.species), times=times, filename=filename,
+                          header={"species": [i.name for i in self.species],
+                                  "seed": seed})
+        with record:
+            record.record(t, None, [i.count for i in self.species])
+            while t <= t_end:
+                r1, r2 = draws.uniform(), draws.uniform()
+                while r1 == 0.:  # U[0, 1) can give 0, where log(1/r1) fails
+                    r1 = draws.uniform()
+                alpha_vec = [i.prop() for i in self.reactions]
+                alpha = float(np.sum(alpha_vec))
+                try:
+                    tau = 1./alpha*math.log(1./r1)
+                except ZeroDivisionError:
+                    print("Propensity equal to zero at step = %d, time = %d;\
+                    Simulation terminated." % (n_steps, t))
                     break
-                elif r2 < float(z)/alpha:
-                    self.reactions[i].perform()
-                    #print self.reactions[i].name
-                    break
-            time.append([t]) 
-            data.append([i.count for i in self.species])
-            if n_steps % 500 == 0:
-                print "Step: %d" % n_steps
-        
-        print "Simulation finished after %d steps" % n_steps
-        data = np.asarray(data)
-        time = np.asarray(time)
-        total = np.hstack((time, data))
-        #np.savetxt(filename, total, header = "Time " + str([i.name for i in self.species]))
-        return total
+
+                t = t + tau
+                n_steps += 1
+                #update species; there is definitely a better/faster way to do this
+                #also find a way to ensure that a reaction happens at every time step
+                #lead -> no two rows in the final array should be the same except time
+                z = 0
+                for i in range(len(alpha_vec)):
+                    z += alpha_vec[i]
+                    if float(z)/alpha == 1.0:
+                        self.reactions[i].perform()
+                        #print self.reactions[i].name
+                        break
+                    elif r2 < float(z)/alpha:
+                        self.reactions[i].perform()
+                        #print self.reactions[i].name
+                        break
+                record.record(t, None, [i.count for i in self.species])
+                if n_steps % 500 == 0:
+                    print("Step: %d" % n_steps)
+        
+            print("Simulation finished after %d steps" % n_steps)
+        return record.finish()
+        
+    def ensemble(self, n_traj, times):
+        """Simulate n_traj independent trajectories in lockstep.
+        
+        Returns the counts sampled on the grid times as an array of shape
+        (n_traj, len(times), species); see gsim_ensemble.
+        """
+        return simulate_ensemble(self.arrays(), n_traj, times)
         
 def output_parser(filename):
     """Read in data for analysis.
     
     Given a data file generated by the simulate method of the Network class,
     read in data as numpy arrays that are amenable to further analysis or
-    visualization.
+    visualization. The file is memory-mapped, so nothing is read until the
+    returned array is used; the header (species names, temperature schedule,
+    seed) is available from gsim_record.read_header.
     """    
-    data = np.loadtxt(filename)
-    pass
\ No newline at end of file
+    return read_trajectory(filename)
\ No newline at end of file
@@ -3,7 +3,16 @@
 Basic implementation of the Gillespie algorithm.
 """
 
+import math
 import numpy as np
+from gsim_array import ArrayNetwork, ARRAY_METHODS
+from gsim_compile import compile_network
+from gsim_ensemble import simulate_ensemble
+from gsim_random import RandomBlock
+from gsim_record import recorder
+import resultcache
+from tschedule import as_schedule
+from ratelaw import Arrhenius, Linear, as_law
 
 class Species(object):
     """A chemical species. Has the inherent properties name and count."""
@@ -27,13 +36,32 @@ class Reaction(object):
     The base class has no perform function! You must explicitly define the
     reaction for each new reaction (for now?)
     Reaction.prop now takes temperature as an input (but does not use)
+    law sets the temperature dependence of the rate constant (see ratelaw):
+    a RateLaw, a function of T, "linear", or "arrhenius" (using Ea, in J).
+    The default is the class's default_law (none for Reaction).
     """
-    def __init__(self, name, ip, op, Ea, baserate):
+    default_law = None
+    
+    def __init__(self, name, ip, op, Ea, baserate, law=None):
         self.name = name
         self.ip = ip
         self.op = op
         self.Ea = Ea
         self.baserate = baserate
+        if law is None:
+            law = self.default_law
+        if law == "linear":
+            law = Linear()
+        elif law == "arrhenius":
+            law = Arrhenius(Ea)
+        self.law = as_law(law)
+        
+    def rate_constant(self, T):
+        """Return the effective rate constant at temperature T (cached per
+        temperature by the rate law)."""
+        if self.law is None:
+            return self.baserate
+        return self.baserate*self.law.factor(T)
     
     def prop(self, T):
         """Return the propensity. Doesn't use T."""
@@ -42,24 +70,35 @@ class Reaction(object):
             alpha *= i.count
             return alpha
         
+    def mass_action(self):
+        """Describe prop as (rate, reactants, T-dependent) for the array
+        engine. Note prop only uses the first input species."""
+        return self.baserate, list(self.ip[:1]), False
+        
     def perform(self):
         #raise error here to ensure definition of the reaction?
         pass
     
 class TDReaction(Reaction):
-    """Defines the base class for a temperature dependent reaction."""
+    """Defines the base class for a temperature dependent reaction.
+    
+    The rate constant is linear in T unless another law is given, e.g.
+    law="arrhenius" for Arrhenius dependence on Ea.
+    """
+    default_law = "linear"
+    
     def prop(self, T):
-        """Return the propensity using T."""
-        alpha = self.baserate*T
+        """Return the propensity using T; a reactant listed n times gives
+        its falling factorial x*(x - 1)*...*(x - n + 1)."""
+        alpha = self.rate_constant(T)
+        seen = []
         for i in self.ip:
-            alpha *= i.count
+            alpha *= i.count - seen.count(i)
+            seen.append(i)
         return alpha
-            
-#    def prop(self, T):
-#        alpha = self.baserate*np.exp(-self.Ea/1.381e-23*(1-(298/T))) #Kb in units of J/K; base temperature assumed to be 298 K
-#        for i in self.ip:
-#            alpha *= i.count
-#            return alpha
+        
+    def mass_action(self):
+        return self.baserate, list(self.ip), self.law
         
 class ConstInduction(Reaction):
     """Production from nothing.
@@ -69,16 +108,19 @@ class ConstInduction(Reaction):
     def prop(self, T):
         return self.baserate
         
+    def mass_action(self):
+        return self.baserate, [], False
+        
     def perform(self):
         self.op[0].produce()
         
 class TConstInduction(TDReaction):
     """Production from nothing at a temperature dependent rate."""
-    #def prop(self, T):
-    #    return self.baserate*np.exp(-self.Ea/1.381e-23*(1-(298/T)))
-    
     def prop(self, T):
-        return self.baserate*T
+        return self.rate_constant(T)
+    
+    def mass_action(self):
+        return self.baserate, [], self.law
     
     def perform(self):
         self.op[0].produce()
@@ -106,26 +148,29 @@ class Network(object):
         self.species = sp_list
         self.reactions = rxn_list
         
+    def arrays(self):
+        """Return the network compiled to arrays (see gsim_array)."""
+        return ArrayNetwork(self.species, self.reactions, temperature=True)
+        
+    def compile(self):
+        """Return the network with a generated simulation loop (see
+        gsim_compile)."""
+        return compile_network(self, temperature=True)
+        
     def determine_temperature(self, temp_fxn, t):
         """Given a step function of time and temperature and the current time
         return the current temperature.
         
         temp_fxn should be formatted as a list of tuples of the form
-        (time, temperature) for all desired changes in temperature.
-        Default T is the first temperature entered.
+        (time, temperature) for all desired changes in temperature (or be a
+        tschedule.TemperatureSchedule). Default T is the first temperature
+        entered.
         """
-        if t < temp_fxn[0][0]:
-            return temp_fxn[0][1]
-        elif t > temp_fxn[len(temp_fxn)-1][0]:
-            return temp_fxn[len(temp_fxn)-1][1]
-        else:
-            for i in range(1,len(temp_fxn)):
-                if t < temp_fxn[i][0]:
-                    return temp_fxn[i-1][1]
-            return temp_fxn[0][1]
-        
-        
-    def simulate(self, t_start, t_end, temp_fxn, filename):
+        return as_schedule(temp_fxn).temperature(t)
+        
+        
+    def simulate(self, t_start, t_end, temp_fxn, filename, method="python",
+                 times=None, seed=None, block=True, **options):
         """Implementation of the Gillespie SSA.
         
         No check on runtime. Make sure to double check rate/times so that
@@ -133,52 +178,111 @@ class Network(object):
         temp_fxn should be formatted as a list of tuples of the form (time, temperature)
         for all desired changes in temperature; t_start < time < t_end.
         Simulation is assumed to start at 298 K. Start with (0,alternate_temp)
-        to alter this behavior.
+        to alter this behavior. T is held for each segment of the schedule;
+        a step that would cross a breakpoint is cut there and redrawn at the
+        new temperature (valid since waiting times are memoryless), and a
+        row is recorded at each breakpoint.
+        Unless filename is None (or "None") the trajectory is streamed to it
+        in the binary format of gsim_record and the returned array is a
+        memory-mapped view of the file (see gsim.output_parser). seed, if
+        given, seeds the random numbers and is kept in the file header.
+        With block=True random numbers are drawn in vectorised blocks (see
+        gsim_random); the trajectory is the same as with scalar draws.
+        method="array" runs the same algorithm on the network compiled to
+        NumPy arrays (see gsim_array); method="next-reaction" uses the
+        Gibson-Bruck next reaction method on the array form; method="tau-leap"
+        uses adaptive (Cao-Gillespie-Petzold) tau-leaping, falling back to
+        exact steps when species run low, for physiological copy numbers;
+        method="hybrid" integrates the reactions among abundant species as
+        ODEs between stochastic firings of the rest (see gsim_hybrid), so
+        rare species such as chaperone mRNA keep their noise;
+        method="compiled" runs the python loop as one generated function
+        with the propensities and updates inlined (see gsim_compile).
+        Extra keyword options (e.g. epsilon) are passed on to the array engine.
+        Events are recorded into preallocated buffers; if times is given
+        only the state holding at each of those times is kept instead.
+        Seeded runs not streamed to a file are looked up in the active
+        resultcache, if there is one.
         """
+        args = (t_start, t_end, temp_fxn, filename, method, times, seed, block, options)
+        if seed is not None and filename in (None, "None") and resultcache.active() is not None:
+            return resultcache.cached_simulation(self, self._simulate, args)
+        return self._simulate(*args)
+
+    def _simulate(self, t_start, t_end, temp_fxn, filename, method, times, seed,
+                  block, options):
         assert t_start < t_end
+        if method in ARRAY_METHODS:
+            return self.arrays().simulate(t_start, t_end, temp_fxn,
+                                          method=ARRAY_METHODS[method], times=times,
+                                          filename=filename, seed=seed, block=block,
+                                          **options)
+        elif method == "compiled":
+            return self.compile().simulate(t_start, t_end, temp_fxn, times=times,
+                                           filename=filename, seed=seed,
+                                           block=block)
+        elif method != "python":
+            raise ValueError("Unknown simulation method: %s" % method)
         t = t_start
         n_steps = 0
-        time = [[t]]
-        data = [[i.count for i in self.species]]
-        temp = [[self.determine_temperature(temp_fxn, t)]]
-        while t <= t_end:
-            T = self.determine_temperature(temp_fxn, t)
-            r1, r2 = np.random.uniform(), np.random.uniform()
-            alpha_vec = [i.prop(T) for i in self.reactions]
-            alpha = np.sum(alpha_vec)
-            try:
-                tau = 1./alpha*np.log(1./r1)
-            except ZeroDivisionError:
-                print "Propensity equal to zero at step = %d, time = %d;\
-                Simulation terminated." % (n_steps, t)
-                break
-
-            t += tau
-            n_steps += 1
-            #update species; there is definitely a better/faster way to do this
-            #also find a way to ensure that a reaction happens at every time step
-            #lead -> no two rows in the final array should be the same except time
-            z = 0
-            for i in range(len(alpha_vec)):
-                z += alpha_vec[i]
-                if float(z)/alpha == 1.0:
-                    self.reactions[i].perform()
-                    #print self.reactions[i].name
-                    break
-                elif r2 < float(z)/alpha:
-                    self.reactions[i].perform()
-                    #print self.reactions[i].name
+        if seed is not None:
+            np.random.seed(seed)
+        draws = RandomBlock() if block else np.random
+        schedule = as_schedule(temp_fxn)
+        T, t_break = schedule.segment(t)
+        record = recorder(len(self.species), temperature=True, times=times,
+                          filename=filename,
+                          header={"species": [i.name for i in self.species],
+                                  "temp_fxn": schedule.temp_fxn, "seed": seed})
+        with record:
+            record.record(t, T, [i.count for i in self.species])
+            while t <= t_end:
+                r1, r2 = draws.uniform(), draws.uniform()
+                while r1 == 0.:  # U[0, 1) can give 0, where log(1/r1) fails
+                    r1 = draws.uniform()
+                alpha_vec = [i.prop(T) for i in self.reactions]
+                alpha = float(np.sum(alpha_vec))
+                try:
+                    tau = 1./alpha*math.log(1./r1)
+                except ZeroDivisionError:
+                    tau = np.inf
+                if t_break <= t_end and t + tau >= t_break:
+                    t = t_break
+                    T, t_break = schedule.segment(t)
+                    record.record(t, T, [i.count for i in self.species])
+                    continue
+                if tau == np.inf:
+                    print("Propensity equal to zero at step = %d, time = %d;\
+                    Simulation terminated." % (n_steps, t))
                     break
-            time.append([t]) 
-            data.append([i.count for i in self.species])
-            temp.append([T])
-            #if n_steps % 500 == 0:
-            #    print "Step: %d" % n_steps
-        
-        print "Simulation finished after %d steps" % n_steps
-        data = np.asarray(data)
-        time = np.asarray(time)
-        temp = np.asarray(temp)
-        total = np.hstack((time, temp, data))
-        #np.savetxt(filename, total, header = "Time " + str([i.name for i in self.species]))
-        return total
+
+                t += tau
+                n_steps += 1
+                #update species; there is definitely a better/faster way to do this
+                #also find a way to ensure that a reaction happens at every time step
+                #lead -> no two rows in the final array should be the same except time
+                z = 0
+                for i in range(len(alpha_vec)):
+                    z += alpha_vec[i]
+                    if float(z)/alpha == 1.0:
+                        self.reactions[i].perform()
+                        #print self.reactions[i].name
+                        break
+                    elif r2 < float(z)/alpha:
+                        self.reactions[i].perform()
+                        #print self.reactions[i].name
+                        break
+                record.record(t, T, [i.count for i in self.species])
+                #if n_steps % 500 == 0:
+                #    print("Step: %d" % n_steps)
+        
+            print("Simulation finished after %d steps" % n_steps)
+        return record.finish()
+        
+    def ensemble(self, n_traj, times, temp_fxn):
+        """Simulate n_traj independent trajectories in lockstep.
+        
+        Returns the counts sampled on the grid times as an array of shape
+        (n_traj, len(times), species); see gsim_ensemble.
+        """
+        return simulate_ensemble(self.arrays(), n_traj, times, temp_fxn)
@@ -0,0 +1,632 @@
+#!/usr/bin/python
+"""
+Array-backed form of a gsim/gsim_A reaction network.
+
+The Species and Reaction objects remain the way a model is written; an
+ArrayNetwork is built from them once per run and holds the state as a NumPy
+vector, the stoichiometry as a matrix and the mass-action propensities as a
+table of reactant indices and orders, so the Gillespie loop is a handful of
+array operations instead of one Python method call per reaction.
+"""
+
+import math
+
+import numpy as np
+import gsim_record
+from gsim_random import RandomBlock
+from tschedule import as_schedule
+from ratelaw import LRUCache, as_law
+
+# Network.simulate method names served by ArrayNetwork.simulate
+ARRAY_METHODS = {"array": "direct", "next-reaction": "next-reaction",
+                 "tau-leap": "tau-leap", "hybrid": "hybrid"}
+
+
+def _owner(cls, attr):
+    """Return the class in the mro of cls which defines attr."""
+    for c in cls.__mro__:
+        if attr in vars(c):
+            return c
+    return None
+
+
+def mass_action_form(rxn):
+    """Return the mass-action description of a reaction, or None.
+
+    A reaction class may describe its propensity by defining a mass_action
+    method returning (rate, reactants) or (rate, reactants, law), where the
+    propensity is rate*prod(count of each reactant), times law.factor(T)
+    for a temperature-dependent law (see ratelaw; True means linear). A
+    species listed n times contributes the falling factorial
+    x*(x - 1)*...*(x - n + 1), the number of ways to pick n molecules. The
+    description is only trusted if it is defined on the same class as the
+    prop method in use, so a subclass which overrides prop with an arbitrary
+    body (e.g. reactivation_A.HeatInducedInactivation) is not mistaken for its
+    parent and falls back to calling prop.
+    """
+    owner = _owner(type(rxn), "prop")
+    if owner is None or "mass_action" not in vars(owner):
+        return None
+    form = vars(owner)["mass_action"](rxn)
+    if len(form) == 2:
+        return form[0], form[1], None
+    return form[0], form[1], as_law(form[2])
+
+
+def falling_factorial(x, order, max_order):
+    """x*(x - 1)*...*(x - order + 1) elementwise (1 where order is 0),
+    with max_order the largest order."""
+    out = np.where(order > 0, x, 1)
+    for m in range(1, max_order):
+        out = out*np.where(order > m, x - m, 1)
+    return out
+
+
+def _involved(rxn):
+    """List the (non-None) Species objects a reaction refers to."""
+    return [s for s in list(rxn.ip or []) + list(rxn.op or []) if s is not None]
+
+
+def probe_stoichiometry(rxn, species):
+    """Return the change in each species count caused by rxn.perform().
+
+    perform is written in terms of produce/destroy calls, so the only reliable
+    way to know what a (possibly user-defined) reaction does is to run it once
+    and look. Counts are restored afterwards.
+    """
+    saved = [s.count for s in species]
+    try:
+        rxn.perform()
+        delta = [s.count - c for s, c in zip(species, saved)]
+    finally:
+        for s, c in zip(species, saved):
+            s.count = c
+    return delta
+
+
+class ArrayNetwork(object):
+    """A reaction network compiled to arrays.
+
+    Built from a list of Species and a list of Reactions (from gsim, or from
+    gsim_A when temperature=True, in which case prop takes T). Reactions whose
+    propensity has a mass-action form are evaluated from the reactant table;
+    the rest call their own prop after the counts of the species they refer
+    to have been written back to the Species objects.
+    """
+    def __init__(self, sp_list, rxn_list, temperature=False, verbose=True,
+                 cache_size=64):
+        self.species = sp_list
+        self.reactions = rxn_list
+        self.temperature = temperature
+        self.verbose = verbose
+        self.names = [s.name for s in sp_list]
+        n_sp = len(sp_list)
+        n_rxn = len(rxn_list)
+        index = dict((id(s), i) for i, s in enumerate(sp_list))
+        self.stoich = np.array([probe_stoichiometry(r, sp_list)
+                                for r in rxn_list], dtype=np.int64).reshape(n_rxn, n_sp)
+        self.rates = np.zeros(n_rxn)
+        self.tdep = np.zeros(n_rxn, dtype=bool)
+        self.laws = [None]*n_rxn
+        table = []
+        self.fallback = []
+        for j, rxn in enumerate(rxn_list):
+            form = mass_action_form(rxn)
+            if form is None:
+                self.fallback.append(j)
+                table.append([])
+                continue
+            rate, reactants, law = form
+            self.rates[j] = rate
+            self.tdep[j] = law is not None
+            self.laws[j] = law
+            orders = {}
+            for s in reactants:
+                orders[index[id(s)]] = orders.get(index[id(s)], 0) + 1
+            table.append(sorted(orders.items()))
+        # Pad the reactant table with a slot holding a constant 1 (index
+        # n_sp of the extended state) so every row has the same width.
+        width = max([len(row) for row in table] + [1])
+        self.reactant_idx = np.full((n_rxn, width), n_sp, dtype=np.int64)
+        self.reactant_order = np.zeros((n_rxn, width), dtype=np.int64)
+        for j, row in enumerate(table):
+            for k, (i, order) in enumerate(row):
+                self.reactant_idx[j, k] = i
+                self.reactant_order[j, k] = order
+        self.max_order = self.reactant_order.max() if n_rxn else 0
+        sync = set()
+        for j in self.fallback:
+            sync.update(index[id(s)] for s in _involved(rxn_list[j])
+                        if id(s) in index)
+        self.sync = sorted(sync)
+        self._is_fallback = set(self.fallback)
+        self._sync_idx = np.array(self.sync, dtype=np.int64)
+        self._sync_species = [sp_list[i] for i in self.sync]
+        self._fallback_pairs = [(j, j) for j in self.fallback]
+        self._xe = np.ones(n_sp + 1, dtype=np.int64)
+        self._T = None
+        self._c = self.rates
+        self._constants = LRUCache(cache_size)
+
+    def state(self):
+        """Return the current Species counts as a state vector."""
+        return np.array([s.count for s in self.species], dtype=np.int64)
+
+    def store(self, x, which=None):
+        """Write (some of) a state vector back to the Species objects."""
+        for i in (range(len(x)) if which is None else which):
+            # item() keeps integer counts ints and hybrid (real) counts floats
+            self.species[i].count = x[i].item()
+
+    def rate_constants(self, T=None):
+        """Return the effective rate constants at temperature T.
+
+        Vectors are cached per temperature (LRU, cache_size entries), so a
+        schedule revisiting the same temperatures evaluates each rate law
+        once per temperature.
+        """
+        if T != self._T and self.temperature:
+            self._T = T
+            self._c = self._constants.get(T, self._rate_constants)
+        return self._c
+
+    def _rate_constants(self, T):
+        c = self.rates.copy()
+        for j, law in enumerate(self.laws):
+            if law is not None:
+                c[j] *= law.factor(T)
+        return c
+
+    def propensities(self, x, T=None):
+        """Return the vector of propensities for state x."""
+        x = np.asarray(x)
+        xe = self._xe if x.dtype.kind in "iu" else np.ones(len(x) + 1)
+        xe[:-1] = x
+        return self._propensities(xe, T)
+
+    def _propensities(self, xe, T, js=None):
+        """Propensities from an extended state (state vector plus a 1), for
+        all reactions or only for the reaction indices js."""
+        c = self.rate_constants(T)
+        if js is None:
+            idx, order = self.reactant_idx, self.reactant_order
+        else:
+            idx, c = self.reactant_idx.take(js, axis=0), c.take(js)
+            order = self.reactant_order.take(js, axis=0)
+        terms = xe.take(idx)
+        if self.max_order > 1:
+            terms = falling_factorial(terms, order, self.max_order)
+        a = c*terms.prod(axis=1)
+        if not self.fallback:
+            return a
+        # (position in a, reaction) of the fallback props to call
+        if js is None:
+            pairs = self._fallback_pairs
+        else:
+            fallback = self._is_fallback
+            pairs = [(k, j) for k, j in enumerate(np.asarray(js).tolist()) if j in fallback]
+        if pairs:
+            # tolist() keeps integer counts ints and hybrid (real) counts floats
+            for s, count in zip(self._sync_species, xe.take(self._sync_idx).tolist()):
+                s.count = count
+            for k, j in pairs:
+                rxn = self.reactions[j]
+                a[k] = rxn.prop(T) if self.temperature else rxn.prop()
+        return a
+
+    def batch_propensities(self, X, T=None):
+        """Return the (N, reactions) propensities of the (N, species) states X.
+
+        T may be None, a scalar or one temperature per row. Fallback props are
+        first tried on whole columns (the Species counts are set to arrays),
+        which works for arithmetic bodies such as Temp_Dimerization; props
+        which can't take arrays (e.g. ones branching on a count) are evaluated
+        row by row.
+        """
+        n = len(X)
+        Xe = np.hstack((X, np.ones((n, 1), dtype=X.dtype)))
+        terms = Xe[:, self.reactant_idx]
+        if self.max_order > 1:
+            terms = falling_factorial(terms, self.reactant_order, self.max_order)
+        if self.temperature and np.ndim(T):
+            temps, rows = np.unique(T, return_inverse=True)
+            c = np.array([self.rate_constants(Ti) for Ti in temps])[rows]
+        else:
+            c = self.rate_constants(T)
+        A = c*terms.prod(axis=2)
+        if not self.fallback:
+            return A
+        saved = [self.species[i].count for i in self.sync]
+        try:
+            for j in self.fallback:
+                rxn = self.reactions[j]
+                for i in self.sync:
+                    self.species[i].count = X[:, i]
+                try:
+                    a = rxn.prop(T) if self.temperature else rxn.prop()
+                    A[:, j] = np.broadcast_to(a, (n,))
+                    continue
+                except (ValueError, TypeError):
+                    pass
+                for r in range(n):
+                    self.store(X[r], self.sync)
+                    Tr = T[r] if np.ndim(T) else T
+                    A[r, j] = rxn.prop(Tr) if self.temperature else rxn.prop()
+        finally:
+            for i, count in zip(self.sync, saved):
+                self.species[i].count = count
+        return A
+
+    def reads(self):
+        """Return, for each reaction, the set of species indices its
+        propensity depends on.
+
+        These are the species in its reactant table, or every species it
+        refers to through ip/op if its propensity is a fallback prop.
+        """
+        n_sp = len(self.species)
+        index = dict((id(s), i) for i, s in enumerate(self.species))
+        reads = []
+        for j, rxn in enumerate(self.reactions):
+            if j in self._is_fallback:
+                reads.append(set(index[id(s)] for s in _involved(rxn) if id(s) in index))
+            else:
+                reads.append(set(i for i in self.reactant_idx[j] if i < n_sp))
+        return reads
+
+    def dependency_graph(self):
+        """Return, for each reaction, the reactions whose propensity must be
+        recomputed after it fires.
+
+        A reaction depends on the species it reads (see reads).
+        Temperature-dependent reactions additionally depend on T, which the
+        simulation loops handle separately.
+        """
+        reads = self.reads()
+        graph = []
+        for j in range(len(self.reactions)):
+            changed = set(np.flatnonzero(self.stoich[j]))
+            graph.append(np.array([k for k in range(len(self.reactions))
+                                   if k == j or reads[k] & changed], dtype=np.int64))
+        return graph
+
+    def select(self, cs, r2):
+        """Pick the index of the reaction to fire from the cumulative
+        propensities cs and a uniform r2."""
+        j = cs.searchsorted(r2*cs[-1], side="right")
+        if j >= len(cs):
+            # rounding pushed r2*a0 past the total; take the last live reaction
+            j = np.flatnonzero(np.diff(np.append(0., cs)))[-1]
+        return j
+
+    def simulate(self, t_start, t_end, temp_fxn=None, method="direct", rng=None,
+                 times=None, filename=None, seed=None, block=True, **options):
+        """Gillespie SSA on the array form.
+
+        method="direct" mirrors Network.simulate (including the random draws,
+        so a seeded run reproduces the object-based loop); "next-reaction" is
+        the Gibson-Bruck next reaction method; "tau-leap" is adaptive explicit
+        tau-leaping (options are passed on to _tau_leap); "hybrid" integrates
+        the reactions among abundant species as ODEs between the firings of
+        the others (options are passed on to gsim_hybrid.hybrid, and counts
+        become real numbers). Returns the same layout as
+        Network.simulate: [time, species...] or, with temperature,
+        [time, T, species...]. The final state is written back to the
+        Species objects. Random numbers come from rng (a numpy Generator or
+        RandomState), by default the global np.random state. If times is
+        given only the state holding at those times is recorded; if filename
+        is given the trajectory is streamed to that file and a memory-mapped
+        view of it is returned (see gsim_record). seed seeds a RandomState
+        when no rng is passed and is stored in the file header. With
+        block=True scalar random numbers are drawn from rng in vectorised
+        blocks (see gsim_random), which leaves the direct method trajectory
+        unchanged.
+        """
+        assert t_start < t_end
+        loops = {"direct": self._direct, "next-reaction": self._next_reaction,
+                 "tau-leap": self._tau_leap, "hybrid": self._hybrid}
+        if method not in loops:
+            raise ValueError("Unknown simulation method: %s" % method)
+        if self.temperature:
+            schedule = as_schedule(temp_fxn)
+            T = schedule.temperature(t_start)
+            temp_fxn = schedule.temp_fxn
+        else:
+            schedule = T = None
+        # x is a view on the extended state xe = [x, 1] used by the
+        # reactant table, so updating x keeps xe current.
+        xe = np.append(self.state(), 1)
+        continuous = method == "hybrid"
+        if continuous:
+            xe = xe.astype(float)
+        x = xe[:-1]
+        header = {"species": self.names, "temp_fxn": temp_fxn, "seed": seed}
+        recorder = gsim_record.recorder(len(x), self.temperature, times,
+                                        filename, header, dtype=xe.dtype)
+        recorder.record(t_start, T, x)
+
+        def record(t, T):
+            recorder.record(t, T, x)
+
+        if rng is None:
+            rng = np.random if seed is None else np.random.RandomState(seed)
+        if block:
+            rng = RandomBlock(rng)
+        with recorder:
+            n_steps = loops[method](xe, t_start, t_end, schedule, record, rng,
+                                    **options)
+        if self.verbose:
+            print("Simulation finished after %d steps" % n_steps)
+        self.store(np.round(x).astype(np.int64) if continuous else x)
+        return recorder.finish()
+
+    def _segment(self, schedule, t):
+        """Return (T, end of the segment) at time t; (None, inf) without
+        temperature."""
+        if schedule is None:
+            return None, np.inf
+        return schedule.segment(t)
+
+    def _direct(self, xe, t, t_end, schedule, record, rng):
+        """Direct method loop; returns the number of steps taken.
+
+        T is constant within a segment of the schedule. A waiting time which
+        would cross the next breakpoint is cut at the breakpoint and drawn
+        again at the new temperature, which is exact because the process is
+        memoryless.
+        """
+        T, t_break = self._segment(schedule, t)
+        x = xe[:-1]
+        stoich = self.stoich
+        n_steps = 0
+        while t <= t_end:
+            r1, r2 = rng.uniform(), rng.uniform()
+            while r1 == 0.:  # U[0, 1) can give 0, where log(1/r1) fails
+                r1 = rng.uniform()
+            cs = self._propensities(xe, T).cumsum()
+            a0 = cs[-1]
+            tau = math.log(1./r1)/a0 if a0 > 0 else np.inf
+            if t_break <= t_end and t + tau >= t_break:
+                t = t_break
+                T, t_break = self._segment(schedule, t)
+                record(t, T)
+                continue
+            if a0 <= 0:
+                if self.verbose:
+                    print("Propensity equal to zero at step = %d, time = %d; "
+                          "Simulation terminated." % (n_steps, t))
+                break
+            t += tau
+            n_steps += 1
+            x += stoich[self.select(cs, r2)]
+            record(t, T)
+        return n_steps
+
+    def _next_reaction(self, xe, t, t_end, schedule, record, rng):
+        """Gibson-Bruck next reaction method; returns the number of steps.
+
+        Each reaction keeps an absolute putative firing time in an indexed
+        priority queue. After a firing only the reactions in the dependency
+        graph of the fired reaction get new propensities, and their times
+        are rescaled rather than redrawn, so the cost of a step depends on
+        the number of dependent reactions rather than the size of the
+        network. At a temperature breakpoint the clock is stopped and the
+        firing times of the T-dependent reactions are rescaled.
+        """
+        T, t_break = self._segment(schedule, t)
+        x = xe[:-1]
+        stoich = self.stoich
+        graph = self.dependency_graph()
+        tsens = np.flatnonzero(self.tdep | np.isin(np.arange(len(self.reactions)),
+                                                   self.fallback))
+        a = self._propensities(xe, T)
+        queue = IndexedPriorityQueue([_firing_time(t, ai, rng) for ai in a])
+        n_steps = 0
+
+        def reschedule(js, t):
+            a_new = self._propensities(xe, T, js)
+            for j, an in zip(js, a_new):
+                ao = a[j]
+                if j == mu or ao <= 0:
+                    queue.update(j, _firing_time(t, an, rng))
+                elif an <= 0:
+                    queue.update(j, np.inf)
+                else:
+                    queue.update(j, t + ao/an*(queue.key(j) - t))
+                a[j] = an
+
+        mu = None
+        while t <= t_end:
+            mu, t_next = queue.top()
+            if t_break <= t_end and t_next >= t_break:
+                t = t_break
+                T, t_break = self._segment(schedule, t)
+                mu = None
+                reschedule(tsens, t)
+                record(t, T)
+                continue
+            if t_next == np.inf:
+                if self.verbose:
+                    print("Propensity equal to zero at step = %d, time = %d; "
+                          "Simulation terminated." % (n_steps, t))
+                break
+            t = t_next
+            n_steps += 1
+            x += stoich[mu]
+            reschedule(graph[mu], t)
+            record(t, T)
+        return n_steps
+
+
+    def _hybrid(self, xe, t, t_end, schedule, record, rng, **options):
+        """Hybrid SSA/ODE loop (see gsim_hybrid)."""
+        from gsim_hybrid import hybrid
+        return hybrid(self, xe, t, t_end, schedule, record, rng, **options)
+
+    def _highest_order(self, x):
+        """Return g_i for each species (Cao, Gillespie & Petzold 2006), the
+        factor bounding the relative change in propensity per relative change
+        in x_i, from the highest order reaction each species is a reactant of.
+        Species only read by fallback props are treated as first order."""
+        g = np.ones(len(x))
+        for idx_row, ord_row in zip(self.reactant_idx, self.reactant_order):
+            hor = ord_row.sum()
+            for i, o in zip(idx_row, ord_row):
+                if o == 0 or hor < 2:
+                    continue
+                xi = max(x[i], 2.)
+                if hor == 2:
+                    gi = 2. if o == 1 else 2. + 1./(xi - 1)
+                elif o == 1:
+                    gi = 3.
+                elif o == 2:
+                    gi = 1.5*(2. + 1./(xi - 1))
+                else:
+                    gi = 3. + 1./(xi - 1) + 2./(xi - 2) if xi > 2 else 3.
+                g[i] = max(g[i], gi)
+        return g
+
+    def _tau_leap(self, xe, t, t_end, schedule, record, rng, epsilon=0.03,
+                  n_critical=10, ssa_factor=10., n_ssa=100):
+        """Adaptive explicit tau-leaping (Cao, Gillespie & Petzold 2006).
+
+        Reactions within n_critical firings of exhausting one of their
+        reactants are critical and fire at most once per leap; the rest fire
+        Poisson(a_j*tau) times, with tau chosen so that the expected relative
+        change of each reactant species' propensity stays below epsilon.
+        When the selected tau is less than ssa_factor/a0 a leap is not worth
+        taking and n_ssa exact direct-method steps are done instead. Leaps
+        never cross a temperature breakpoint or t_end, and a leap which would
+        drive a count negative is retried with half the step. Returns the
+        number of steps (leaps plus exact steps) taken.
+        """
+        x = xe[:-1]
+        stoich = self.stoich
+        consumed = np.maximum(-stoich, 0)
+        reactant = consumed.any(axis=0)
+        n_steps = 0
+        while t < t_end:
+            T, t_break = self._segment(schedule, t)
+            horizon = min(t_end, t_break)
+            a = self._propensities(xe, T)
+            a0 = a.sum()
+            if a0 <= 0 and horizon < t_end:
+                t = horizon
+                record(t, T)
+                continue
+            if a0 <= 0:
+                if self.verbose:
+                    print("Propensity equal to zero at step = %d, time = %d; "
+                          "Simulation terminated." % (n_steps, t))
+                break
+            # Number of firings left before a reaction exhausts a reactant
+            with np.errstate(divide="ignore"):
+                left = np.where(consumed > 0, x//np.maximum(consumed, 1), np.inf).min(axis=1)
+            critical = (a > 0) & (left < n_critical)
+            a_nc = np.where(critical, 0., a)
+            mu = stoich.T.dot(a_nc)
+            sigma2 = (stoich**2).T.dot(a_nc)
+            bound = np.maximum(epsilon*x/self._highest_order(x), 1.)
+            with np.errstate(divide="ignore"):
+                tau1 = np.min(np.where(reactant, np.minimum(bound/np.abs(mu), bound**2/sigma2), np.inf))
+            if tau1 < ssa_factor/a0:
+                # Leaping would take too few firings per step; step exactly.
+                for k in range(n_ssa):
+                    cs = self._propensities(xe, T).cumsum()
+                    dt = rng.exponential()/cs[-1] if cs[-1] > 0 else np.inf
+                    if t + dt >= horizon:
+                        t = horizon
+                        record(t, T)
+                        break
+                    t += dt
+                    n_steps += 1
+                    x += stoich[self.select(cs, rng.uniform())]
+                    record(t, T)
+                continue
+            a0_c = a[critical].sum()
+            while True:
+                tau2 = rng.exponential()/a0_c if a0_c > 0 else np.inf
+                tau = min(tau1, tau2, horizon - t)
+                k = rng.poisson(a_nc*tau)
+                if tau == tau2:
+                    cs = np.where(critical, a, 0.).cumsum()
+                    k[self.select(cs, rng.uniform())] += 1
+                x_new = x + k.dot(stoich)
+                if (x_new >= 0).all():
+                    break
+                tau1 = tau/2.
+            x[:] = x_new
+            t += tau
+            n_steps += 1
+            record(t, T)
+        return n_steps
+
+
+def _firing_time(t, a, rng):
+    """Absolute time of the next firing of a channel with propensity a."""
+    if a <= 0:
+        return np.inf
+    return t + rng.exponential()/a
+
+
+class IndexedPriorityQueue(object):
+    """Binary min-heap of reaction firing times addressable by reaction index.
+
+    update(j, key) changes the key of reaction j in O(log n) by keeping the
+    position of each reaction in the heap alongside the heap itself.
+    """
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.heap = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+        self.pos = [0]*len(self.keys)
+        for p, j in enumerate(self.heap):
+            self.pos[j] = p
+
+    def top(self):
+        """Return (index, key) of the smallest key."""
+        j = self.heap[0]
+        return j, self.keys[j]
+
+    def key(self, j):
+        return self.keys[j]
+
+    def update(self, j, key):
+        """Set the key of reaction j and restore the heap order."""
+        old = self.keys[j]
+        self.keys[j] = key
+        if key < old:
+            self._up(self.pos[j])
+        elif key > old:
+            self._down(self.pos[j])
+
+    def _swap(self, p, q):
+        heap, pos = self.heap, self.pos
+        heap[p], heap[q] = heap[q], heap[p]
+        pos[heap[p]] = p
+        pos[heap[q]] = q
+
+    def _up(self, p):
+        keys, heap = self.keys, self.heap
+        while p > 0:
+            parent = (p - 1)//2
+            if keys[heap[p]] < keys[heap[parent]]:
+                self._swap(p, parent)
+                p = parent
+            else:
+                break
+
+    def _down(self, p):
+        keys, heap = self.keys, self.heap
+        n = len(heap)
+        while True:
+            child = 2*p + 1
+            if child >= n:
+                break
+            if child + 1 < n and keys[heap[child + 1]] < keys[heap[child]]:
+                child += 1
+            if keys[heap[child]] < keys[heap[p]]:
+                self._swap(p, child)
+                p = child
+            else:
+                break
+
@@ -0,0 +1,255 @@
+#!/usr/bin/python
+"""
+Code-generated Gillespie loops for a Network.
+
+The python loop of Network.simulate calls prop() and perform() through the
+Reaction class hierarchy for every reaction at every step. compile_network
+instead writes the Python source of one direct-method loop specialised to
+the network, with the species counts held in local integer variables and
+every propensity and update written out inline, and execs it once.
+
+A propensity is inlined from its mass_action description (see gsim_array)
+or, for a reaction class whose prop has an arbitrary body, from an
+expression method defined on the same class as prop:
+
+    def expression(self, count):
+        return "%(k)s*" + count(self.ip[0])
+
+returning the propensity as Python source in which count(species) is the
+variable holding a species count, %(k)s the rate constant at the current
+temperature and %(c)s the base rate (sqrt and exp are available). Any other
+reaction falls back to calling its own prop, after the counts of the
+species it refers to have been written back to the Species objects.
+
+Generated kernels are cached by the structure of the network (species
+count, stoichiometry and the form of each propensity), so networks which
+only differ in their rates and initial counts share one kernel.
+"""
+
+import math
+
+import numpy as np
+from gsim_array import _involved, _owner, mass_action_form, probe_stoichiometry
+from gsim_random import RandomBlock
+from gsim_record import recorder
+from ratelaw import LRUCache
+from tschedule import as_schedule
+
+_kernels = LRUCache(64)
+
+
+def expression_form(rxn, count):
+    """Return the inline source of a reaction's propensity, or None.
+
+    As for mass_action, the expression is only trusted if it is defined on
+    the class defining the prop in use.
+    """
+    owner = _owner(type(rxn), "prop")
+    if owner is None or "expression" not in vars(owner):
+        return None
+    return vars(owner)["expression"](rxn, count)
+
+
+def _base_rate(rxn):
+    return rxn.baserate if hasattr(rxn, "baserate") else rxn.rate
+
+
+def _rate_function(rxn, law, rate):
+    """Return the function of T giving the rate constant of rxn."""
+    if law is not None:
+        return lambda T: rate*law.factor(T)
+    if hasattr(rxn, "rate_constant"):
+        return rxn.rate_constant
+    return lambda T: rate
+
+
+def _describe(network, temperature):
+    """Return (structure key, constants) of a network.
+
+    The key determines the generated source; the constants (rates, rate
+    functions, Species and Reaction objects) are passed to the kernel when
+    it runs.
+    """
+    species = network.species
+    index = dict((id(s), i) for i, s in enumerate(species))
+
+    def count(s):
+        return "x%d" % index[id(s)]
+
+    forms = []
+    rates, rate_fns = [], []
+    for rxn in network.reactions:
+        form = mass_action_form(rxn)
+        if form is not None:
+            rate, reactants, law = form
+            forms.append(("mass", tuple(sorted(index[id(s)] for s in reactants)),
+                          law is not None))
+            rates.append(rate)
+            rate_fns.append(_rate_function(rxn, law, rate))
+            continue
+        expr = expression_form(rxn, count)
+        if expr is not None:
+            forms.append(("expr", expr))
+            rates.append(_base_rate(rxn))
+            rate_fns.append(_rate_function(rxn, None, _base_rate(rxn)))
+            continue
+        forms.append(("prop", tuple(sorted(index[id(s)] for s in _involved(rxn)
+                                           if id(s) in index))))
+        rates.append(None)
+        rate_fns.append(None)
+    stoich = tuple(tuple(probe_stoichiometry(r, species)) for r in network.reactions)
+    key = (len(species), bool(temperature), tuple(forms), stoich)
+    return key, (rates, rate_fns, list(species), list(network.reactions))
+
+
+def generate(key):
+    """Return the source of the kernel for a structure key."""
+    n_sp, temperature, forms, stoich = key
+    T_arg = "T" if temperature else ""
+    state = "[%s]" % ", ".join("x%d" % i for i in range(n_sp))
+    lines = ["def kernel(t, t_end, T, t_break, segment, draws, record, X, C, K, S, R):"]
+    add = lines.append
+    if n_sp:
+        add("    %s, = X" % ", ".join("x%d" % i for i in range(n_sp)))
+    sync = set()
+    tdep = []
+    props = []
+    for j, form in enumerate(forms):
+        kind = form[0]
+        if kind == "mass":
+            reactants, is_tdep = form[1], form[2]
+            if is_tdep and temperature:
+                tdep.append(j)
+                rate = "k%d" % j
+            else:
+                add("    c%d = C[%d]" % (j, j))
+                rate = "c%d" % j
+            # a repeated reactant gives its falling factorial, as in gsim_array
+            factors = [rate]
+            for i in sorted(set(reactants)):
+                factors += ["x%d" % i if m == 0 else "(x%d - %d)" % (i, m)
+                            for m in range(reactants.count(i))]
+            props.append("*".join(factors))
+        elif kind == "expr":
+            add("    c%d = C[%d]" % (j, j))
+            if temperature:
+                tdep.append(j)
+                names = {"k": "k%d" % j, "c": "c%d" % j}
+            else:
+                names = {"k": "c%d" % j, "c": "c%d" % j}
+            props.append("(%s)" % (form[1] % names))
+        else:
+            add("    p%d = R[%d].prop" % (j, j))
+            sync.update(form[1])
+            props.append("p%d(%s)" % (j, T_arg))
+    for i in sorted(sync):
+        add("    s%d = S[%d]" % (i, i))
+    for j in tdep:
+        add("    K%d = K[%d]" % (j, j))
+        add("    k%d = K%d(T)" % (j, j))
+    add("    uniform = draws.uniform")
+    add("    n_steps = 0")
+    add("    while t <= t_end:")
+    add("        r1 = uniform()")
+    add("        r2 = uniform()")
+    # U[0, 1) can give 0, where log(1/r1) fails; redraw as the loops do
+    add("        while r1 == 0.:")
+    add("            r1 = uniform()")
+    for i in sorted(sync):
+        add("        s%d.count = x%d" % (i, i))
+    for j, prop in enumerate(props):
+        add("        a%d = %s" % (j, prop))
+    add("        alpha = float(%s)" % (" + ".join("a%d" % j for j in range(len(props))) or "0"))
+    add("        try:")
+    add("            tau = 1./alpha*log(1./r1)")
+    add("        except ZeroDivisionError:")
+    add("            tau = inf")
+    if temperature:
+        add("        if t_break <= t_end and t + tau >= t_break:")
+        add("            t = t_break")
+        add("            T, t_break = segment(t)")
+        for j in tdep:
+            add("            k%d = K%d(T)" % (j, j))
+        add("            record(t, T, %s)" % state)
+        add("            continue")
+    add("        if tau == inf:")
+    add("            break")
+    add("        t += tau")
+    add("        n_steps += 1")
+    for j in range(len(props)):
+        add("        z%d = %s" % (j, "a0" if j == 0 else "z%d + a%d" % (j - 1, j)))
+    for j, row in enumerate(stoich):
+        add("        %s z%d/alpha == 1.0 or r2 < z%d/alpha:" % ("if" if j == 0 else "elif", j, j))
+        changes = ["x%d %s= %d" % (i, "+" if d > 0 else "-", abs(d))
+                   for i, d in enumerate(row) if d]
+        for change in changes or ["pass"]:
+            add("            " + change)
+    add("        record(t, T, %s)" % state)
+    add("    return t, n_steps, %s" % state)
+    return "\n".join(lines) + "\n"
+
+
+def _build(key):
+    source = generate(key)
+    namespace = {"log": math.log, "sqrt": math.sqrt, "exp": math.exp,
+                 "inf": np.inf, "np": np}
+    exec(compile(source, "<gsim kernel>", "exec"), namespace)
+    return source, namespace["kernel"]
+
+
+class CompiledNetwork(object):
+    """A Network with its generated direct-method loop.
+
+    The rates are read from the reactions at every run, so they can be
+    changed between runs; changing the reactions or species themselves
+    needs a new compile.
+    """
+    def __init__(self, network, temperature=False):
+        self.network = network
+        self.temperature = temperature
+        self.key = _describe(network, temperature)[0]
+        self.source, self.kernel = _kernels.get(self.key, _build)
+
+    def simulate(self, t_start, t_end, temp_fxn=None, times=None, filename=None,
+                 seed=None, block=True, verbose=True):
+        """Run the generated loop; arguments and output as Network.simulate.
+
+        The random numbers are drawn as in the python loop, so a seeded run
+        gives the same trajectory. The final counts are written back to the
+        Species objects.
+        """
+        assert t_start < t_end
+        rates, rate_fns, species, reactions = _describe(self.network, self.temperature)[1]
+        if seed is not None:
+            np.random.seed(seed)
+        draws = RandomBlock() if block else np.random
+        header = {"species": [s.name for s in species], "seed": seed}
+        if self.temperature:
+            schedule = as_schedule(temp_fxn)
+            T, t_break = schedule.segment(t_start)
+            header["temp_fxn"] = schedule.temp_fxn
+            segment = schedule.segment
+        else:
+            T, t_break, segment = None, np.inf, None
+        rec = recorder(len(species), temperature=self.temperature, times=times,
+                       filename=filename, header=header)
+        X = [s.count for s in species]
+        with rec:
+            rec.record(t_start, T, X)
+            t, n_steps, X = self.kernel(t_start, t_end, T, t_break, segment,
+                                        draws, rec.record, X, rates, rate_fns,
+                                        species, reactions)
+        for s, c in zip(species, X):
+            s.count = c
+        if verbose:
+            if t <= t_end:
+                print("Propensity equal to zero at step = %d, time = %d; "
+                      "Simulation terminated." % (n_steps, t))
+            print("Simulation finished after %d steps" % n_steps)
+        return rec.finish()
+
+
+def compile_network(network, temperature=False):
+    """Return the CompiledNetwork of a gsim (or, with temperature=True,
+    gsim_A) Network."""
+    return CompiledNetwork(network, temperature)
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+"""
+Ensembles of Gillespie trajectories.
+
+simulate_ensemble advances N independent trajectories of one network in
+lockstep: the state is an (N, species) count matrix, propensities are
+evaluated for all rows at once and each step draws N exponentials and N
+uniforms, so a replicate run costs a few array operations per step instead of
+a Python loop over Network.simulate calls.
+
+run_ensemble instead spreads independent Network.simulate replicates over a
+process pool. Each trajectory draws from its own np.random.Generator spawned
+from a SeedSequence, so runs are reproducible individually and independent
+of the number of workers, and each worker rebuilds the network from a
+picklable description (describe/rebuild) rather than sharing Species objects.
+"""
+
+import importlib
+
+import numpy as np
+from gsim_array import ARRAY_METHODS
+from tschedule import as_schedule
+import resultcache
+
+
+def simulate_ensemble(net, n_traj, times, temp_fxn=None, rng=None):
+    """Run n_traj direct-method trajectories of an ArrayNetwork together.
+
+    All trajectories start from the current Species counts (which are left
+    unchanged) and are sampled on the common grid times; the state at a grid
+    point is the state holding at that time. Returns an array of shape
+    (n_traj, len(times), species). rng defaults to the global np.random
+    state. As in Network.simulate, a waiting time crossing a temperature
+    breakpoint is cut there and redrawn.
+    """
+    if rng is None:
+        rng = np.random
+    times = np.asarray(times, dtype=float)
+    n_grid = len(times)
+    X = np.tile(net.state(), (n_traj, 1))
+    out = np.empty((n_traj, n_grid, X.shape[1]), dtype=X.dtype)
+    t = np.full(n_traj, times[0])
+    filled = np.zeros(n_traj, dtype=np.int64)
+    active = np.arange(n_traj)
+    stoich = net.stoich
+    schedule = as_schedule(temp_fxn) if net.temperature else None
+    while len(active):
+        Xa = X[active]
+        if schedule is None:
+            T = None
+            t_break = np.full(len(active), np.inf)
+        else:
+            T = schedule.temperatures(t[active])
+            t_break = schedule.next_breakpoints(t[active])
+        cs = net.batch_propensities(Xa, T).cumsum(axis=1)
+        a0 = cs[:, -1]
+        with np.errstate(divide="ignore"):
+            t_next = t[active] + rng.exponential(size=len(active))/a0
+        # Rows whose waiting time crosses a breakpoint stop there instead.
+        cross = t_next >= t_break
+        t_next = np.minimum(t_next, t_break)
+        # Rows keep their current state up to the next event, so fill every
+        # grid point before it.
+        while True:
+            g = filled[active]
+            due = g < n_grid
+            due[due] = times[g[due]] < t_next[due]
+            if not due.any():
+                break
+            rows = active[due]
+            out[rows, g[due]] = Xa[due]
+            filled[rows] += 1
+        live = (filled[active] < n_grid) & ((a0 > 0) | cross)
+        active, cs, a0, t_next, cross = (active[live], cs[live], a0[live],
+                                         t_next[live], cross[live])
+        t[active] = t_next
+        fire = ~cross
+        rows, cs, a0 = active[fire], cs[fire], a0[fire]
+        if not len(rows):
+            continue
+        r2 = rng.uniform(size=len(rows))
+        j = (cs <= (r2*a0)[:, None]).sum(axis=1)
+        # rounding can push r2*a0 past the total; take the last live reaction
+        last = cs.shape[1] - 1 - np.argmax((np.diff(cs, axis=1, prepend=0.) > 0)[:, ::-1], axis=1)
+        j = np.minimum(j, last)
+        X[rows] += stoich[j]
+    return out
+
+
+class _SpeciesRef(object):
+    """Placeholder for the Species at position index in a description."""
+    def __init__(self, index):
+        self.index = index
+
+
+def _class_ref(cls):
+    return cls.__module__, cls.__name__
+
+
+def _load_class(ref):
+    return getattr(importlib.import_module(ref[0]), ref[1])
+
+
+def describe(network):
+    """Return a picklable description of a gsim/gsim_A Network.
+
+    Classes are recorded by module and name and every attribute of the
+    Species and Reactions is kept, with references to the network's Species
+    (also inside lists) replaced by their position, so any Reaction subclass
+    can be described without knowing its constructor.
+    """
+    index = dict((id(s), i) for i, s in enumerate(network.species))
+
+    def encode(v):
+        if id(v) in index:
+            return _SpeciesRef(index[id(v)])
+        if isinstance(v, (list, tuple)):
+            return type(v)(encode(i) for i in v)
+        return v
+
+    return {"network": _class_ref(type(network)),
+            "species": [(_class_ref(type(s)), dict(vars(s))) for s in network.species],
+            "reactions": [(_class_ref(type(r)), dict((k, encode(v)) for k, v in vars(r).items()))
+                          for r in network.reactions]}
+
+
+def rebuild(description):
+    """Build a fresh Network (with its own Species objects) from describe()."""
+    species = []
+    for ref, attrs in description["species"]:
+        s = object.__new__(_load_class(ref))
+        s.__dict__.update(attrs)
+        species.append(s)
+
+    def decode(v):
+        if isinstance(v, _SpeciesRef):
+            return species[v.index]
+        if isinstance(v, (list, tuple)):
+            return type(v)(decode(i) for i in v)
+        return v
+
+    reactions = []
+    for ref, attrs in description["reactions"]:
+        r = object.__new__(_load_class(ref))
+        r.__dict__.update((k, decode(v)) for k, v in attrs.items())
+        reactions.append(r)
+    return _load_class(description["network"])(species, reactions)
+
+
+def _run_chunk(args):
+    """Worker: simulate one chunk of trajectories, one Generator each."""
+    description, seeds, t_start, t_end, temp_fxn, method, options = args
+    out = []
+    for seed in seeds:
+        arrays = rebuild(description).arrays()
+        arrays.verbose = False
+        out.append(arrays.simulate(t_start, t_end, temp_fxn, method=ARRAY_METHODS[method],
+                                   rng=np.random.default_rng(seed), **options))
+    return out
+
+
+def trajectory_seed(seed, k):
+    """Return the SeedSequence run_ensemble(seed=seed) uses for trajectory k."""
+    return np.random.SeedSequence(seed, spawn_key=(k,))
+
+
+def run_ensemble(network, n_traj, t_start, t_end, temp_fxn=None, method="array",
+                 seed=None, workers=None, chunksize=1, **options):
+    """Simulate n_traj independent trajectories over a process pool.
+
+    Returns the list of Network.simulate outputs in trajectory order.
+    method is one of the array methods of Network.simulate ("array",
+    "next-reaction", "tau-leap", "hybrid") and options are passed on to it. Trajectory
+    k uses trajectory_seed(seed, k), so any single run can be reproduced on
+    its own; chunksize trajectories are sent to a worker at a time. The
+    network itself is not modified. workers=1 runs in this process. A
+    seeded ensemble is looked up in the active resultcache, if there is
+    one.
+    """
+    if method not in ARRAY_METHODS:
+        raise ValueError("Unknown ensemble method: %s" % method)
+    description = describe(network)
+    cache = resultcache.active()
+    if seed is not None and cache is not None:
+        key = resultcache.digest("ensemble", description,
+                                 resultcache.classes(network), n_traj, t_start,
+                                 t_end, temp_fxn, method, seed, options)
+        arrays = cache.cached(key, lambda: dict(
+            ("run%d" % k, np.asarray(x)) for k, x in enumerate(
+                _run_ensemble(description, n_traj, t_start, t_end, temp_fxn,
+                              method, seed, workers, chunksize, options))))
+        return [arrays["run%d" % k] for k in range(n_traj)]
+    return _run_ensemble(description, n_traj, t_start, t_end, temp_fxn, method,
+                         seed, workers, chunksize, options)
+
+
+def _run_ensemble(description, n_traj, t_start, t_end, temp_fxn, method, seed,
+                  workers, chunksize, options):
+    from concurrent.futures import ProcessPoolExecutor
+    root = np.random.SeedSequence(seed)
+    seeds = [trajectory_seed(root.entropy, k) for k in range(n_traj)]
+    tasks = [(description, seeds[i:i + chunksize], t_start, t_end, temp_fxn,
+              method, options) for i in range(0, n_traj, chunksize)]
+    if workers == 1:
+        chunks = map(_run_chunk, tasks)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunks = list(pool.map(_run_chunk, tasks))
+    return [x for chunk in chunks for x in chunk]
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+"""
+Hybrid SSA/ODE simulation of an ArrayNetwork.
+
+Heat-shock models mix abundant species (Pab1 ~10^5, bulk mRNA ~36000), for
+which the SSA spends nearly all its steps, with rare ones (chaperone mRNA ~5
+copies) whose noise an ODE model loses. The hybrid loop partitions the
+reactions by copy number: a reaction is fast if every species it changes is
+abundant. Fast reactions are integrated as ODEs (the species they change
+become real-valued); rare species they only read, such as the mRNA of a
+translation reaction, are constant between slow firings. The slow reactions
+fire stochastically, with the time of the next slow firing found as the
+root of
+
+    integral of a_slow(x(s)) ds = Exp(1) draw
+
+along the ODE solution (Haseltine & Rawlings 2002), so slow propensities
+which change with the fast species are handled exactly. The partition is
+revised after every slow firing and whenever an abundant species falls
+below half the threshold (the hysteresis stops species flipping back and
+forth). Without fast reactions each step is an exact direct-method step, so
+with a high threshold the loop is the plain SSA.
+"""
+
+import numpy as np
+from scipy.integrate import solve_ivp
+
+
+def _abundant(x, abundant, threshold):
+    """Return the abundant flags for state x given the previous flags.
+
+    A species becomes abundant at threshold copies and stays so while it has
+    more than threshold/2.
+    """
+    return np.where(abundant, x > threshold/2., x >= threshold)
+
+
+def hybrid(net, xe, t, t_end, schedule, record, rng, threshold=1000.,
+           solver="LSODA", rtol=1e-6, atol=1e-6, max_step=np.inf):
+    """Hybrid loop for ArrayNetwork.simulate; returns the number of steps
+    (slow firings plus ODE segments).
+
+    xe is the real-valued extended state. threshold is the copy number at
+    which a species counts as abundant; solver, rtol, atol and max_step are
+    passed on to scipy.integrate.solve_ivp. Every step of the ODE solver is
+    recorded (with times, the grid takes the last step before each point,
+    so lower max_step for a finer sampling). Species which stop being changed by fast reactions are
+    rounded back to integers. Segments never cross a temperature breakpoint.
+    """
+    x = xe[:-1]
+    n_sp = len(x)
+    stoich = net.stoich.astype(float)
+    changed = net.stoich != 0
+    reacts = changed.any(axis=1)
+    abundant = np.zeros(n_sp, dtype=bool)
+    fast = None
+    target = rng.exponential()
+    n_steps = 0
+    while t < t_end:
+        T, t_break = net._segment(schedule, t)
+        horizon = min(t_end, t_break)
+        flags = _abundant(x, abundant, threshold)
+        if fast is None or (flags != abundant).any():
+            abundant = flags
+            fast = reacts & ~(changed & ~abundant).any(axis=1)
+            slow = ~fast
+            continuous = changed[fast].any(axis=0)
+            x[~continuous] = np.round(x[~continuous])
+
+        if not fast.any():
+            # Propensities only change at firings: exact direct method step.
+            cs = net._propensities(xe, T).cumsum()
+            a0 = cs[-1]
+            if a0 <= 0 and horizon == t_end:
+                if net.verbose:
+                    print("Propensity equal to zero at step = %d, time = %d; "
+                          "Simulation terminated." % (n_steps, t))
+                break
+            if a0 <= 0 or t + target/a0 >= horizon:
+                target -= a0*(horizon - t)
+                t = horizon
+                record(t, T)
+                continue
+            t += target/a0
+            x += stoich[net.select(cs, rng.uniform())]
+            target = rng.exponential()
+            n_steps += 1
+            record(t, T)
+            continue
+
+        S_fast = stoich[fast].T
+        cont = np.flatnonzero(continuous)
+        low = threshold/2.
+
+        def rhs(s, y):
+            xe[:-1] = y[:-1]
+            a = net._propensities(xe, T)
+            return np.append(S_fast.dot(a[fast]), a[slow].sum())
+
+        def fire(s, y):
+            return y[-1] - target
+        fire.terminal = True
+        fire.direction = 1
+
+        def deplete(s, y):
+            return y[cont].min() - low
+        deplete.terminal = True
+        deplete.direction = -1
+
+        sol = solve_ivp(rhs, (t, horizon), np.append(x, 0.), method=solver,
+                        events=[fire, deplete], rtol=rtol, atol=atol,
+                        max_step=max_step)
+        if sol.status < 0:
+            raise RuntimeError("ODE integration failed at t = %g: %s" % (t, sol.message))
+        n_steps += 1
+        for s, y in zip(sol.t[1:], sol.y[:-1, 1:].T):
+            x[:] = y
+            record(s, T)
+        t = sol.t[-1]
+        x[:] = np.maximum(sol.y[:-1, -1], 0.)
+        if len(sol.t_events[0]):
+            # A slow reaction fires, chosen at the current propensities.
+            cs = np.where(slow, net._propensities(xe, T), 0.).cumsum()
+            x += stoich[net.select(cs, rng.uniform())]
+            target = rng.exponential()
+            n_steps += 1
+            record(t, T)
+            continue
+        target -= sol.y[-1, -1]
+        if len(sol.t_events[1]):
+            # The depleted species leaves the abundant set.
+            abundant[cont[np.argmin(x[cont])]] = False
+            fast = None
+    return n_steps
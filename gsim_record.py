@@ -0,0 +1,249 @@
+#!/usr/bin/python
+"""
+Trajectory recorders for the Gillespie loops.
+
+A recorder is told record(t, T, x) whenever the state changes: from time t
+the counts are x (and the temperature T). EventRecorder keeps every event in
+preallocated NumPy buffers that grow geometrically; GridRecorder only keeps
+the state holding at a fixed list of output times; StreamRecorder writes the
+events to disk in chunks as the run goes. All return the layout of
+Network.simulate: [time, species...], or [time, T, species...] for
+temperature-dependent networks. Recorders are context managers, so an
+engine running inside "with recorder(...) as record:" closes the stream
+file if the run raises.
+
+Trajectory files are a small header followed by the rows as little-endian
+float64, so read_trajectory can memory-map them without reading the data:
+
+    b"GSIMTRJ1" | uint32 header length | JSON header | padding | rows
+
+The JSON header holds the column names, the species names, the temperature
+schedule and the seed of the run.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b"GSIMTRJ1"
+_ALIGN = 64
+
+
+class _Recorder(object):
+    """Context manager base: leaving the block by an exception closes any
+    open file, so a failed run does not leak its handle."""
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if kind is not None:
+            self.close()
+        return False
+
+
+class EventRecorder(_Recorder):
+    """Record every event into geometrically grown buffers."""
+    def __init__(self, n_species, temperature=False, capacity=1024, dtype=np.int64):
+        self.temperature = temperature
+        self.n = 0
+        self.time = np.empty(capacity)
+        self.temp = np.empty(capacity)
+        self.data = np.empty((capacity, n_species), dtype=dtype)
+
+    def _grow(self):
+        capacity = 2*len(self.time)
+        for name in ("time", "temp", "data"):
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, name, new)
+
+    def record(self, t, T, x):
+        if self.n == len(self.time):
+            self._grow()
+        self.time[self.n] = t
+        if self.temperature:
+            self.temp[self.n] = T
+        self.data[self.n] = x
+        self.n += 1
+
+    def finish(self):
+        """Return the recorded trajectory as one array."""
+        n = self.n
+        columns = [self.time[:n, None]]
+        if self.temperature:
+            columns.append(self.temp[:n, None])
+        columns.append(self.data[:n])
+        return np.hstack(columns)
+
+
+class StreamRecorder(_Recorder):
+    """Write events to a trajectory file in chunks of chunk rows.
+
+    Only one chunk is held in memory; finish returns a memory-mapped view
+    of the finished file.
+    """
+    def __init__(self, filename, n_species, temperature=False, header=None,
+                 chunk=65536):
+        self.filename = filename
+        self.temperature = temperature
+        self.buffer = np.empty((chunk, n_species + (2 if temperature else 1)))
+        self.n = 0
+        self.handle = open(filename, "wb")
+        try:
+            write_header(self.handle, _header(n_species, temperature, header))
+        except Exception:
+            self.handle.close()
+            raise
+
+    def flush(self):
+        self.handle.write(self.buffer[:self.n].astype("<f8").tobytes())
+        self.n = 0
+
+    def record(self, t, T, x):
+        if self.n == len(self.buffer):
+            self.flush()
+        row = self.buffer[self.n]
+        row[0] = t
+        if self.temperature:
+            row[1] = T
+        row[-len(x):] = x
+        self.n += 1
+
+    def close(self):
+        """Close the file; rows already flushed stay readable."""
+        if not self.handle.closed:
+            self.handle.close()
+
+    def finish(self):
+        self.flush()
+        self.close()
+        return read_trajectory(self.filename)
+
+
+class GridRecorder(_Recorder):
+    """Record the state holding at each of the (increasing) output times.
+
+    Memory is fixed by the grid, however many events the run takes. Grid
+    points after the end of the run hold the final state. If filename is
+    given the sampled trajectory is also written there by finish.
+    """
+    def __init__(self, times, n_species, temperature=False, filename=None,
+                 header=None, dtype=np.int64):
+        self.filename = filename
+        self.header = _header(n_species, temperature, header)
+        self.temperature = temperature
+        self.times = np.asarray(times, dtype=float)
+        self.temp = np.empty(len(self.times))
+        self.data = np.empty((len(self.times), n_species), dtype=dtype)
+        self.filled = 0
+        self.current = None
+
+    def _fill(self, t):
+        """Write the current state to the grid points before t."""
+        stop = np.searchsorted(self.times, t, side="left")
+        if stop > self.filled:
+            T, x = self.current
+            self.temp[self.filled:stop] = T if self.temperature else 0
+            self.data[self.filled:stop] = x
+            self.filled = stop
+
+    def record(self, t, T, x):
+        if self.current is not None:
+            self._fill(t)
+        self.current = (T, np.array(x, dtype=self.data.dtype))
+
+    def finish(self):
+        """Return the sampled trajectory as one array."""
+        self._fill(np.inf)
+        columns = [self.times[:, None]]
+        if self.temperature:
+            columns.append(self.temp[:, None])
+        columns.append(self.data)
+        total = np.hstack(columns)
+        if self.filename is None:
+            return total
+        write_trajectory(self.filename, total, self.header)
+        return read_trajectory(self.filename)
+
+
+def recorder(n_species, temperature=False, times=None, filename=None, header=None,
+             dtype=np.int64):
+    """Return the recorder for a run.
+
+    A GridRecorder on times if given, else a StreamRecorder to filename if
+    given, else an EventRecorder. header is a dict of extra header fields
+    (species, temp_fxn, seed) for files. The strings "None" and "" are
+    treated as no file, as scripts pass them for the unused argument.
+    dtype is the type of the recorded counts (float for hybrid runs; files
+    always store float64).
+    """
+    if filename in ("None", ""):
+        filename = None
+    if times is not None:
+        return GridRecorder(times, n_species, temperature, filename, header, dtype)
+    if filename is not None:
+        return StreamRecorder(filename, n_species, temperature, header)
+    return EventRecorder(n_species, temperature, dtype=dtype)
+
+
+def _header(n_species, temperature, extra=None):
+    """Build a file header dict from the shape of a run and extra fields."""
+    header = {"species": ["x%d" % i for i in range(n_species)],
+              "temp_fxn": None, "seed": None}
+    header.update(extra or {})
+    header["columns"] = ["time"] + (["T"] if temperature else []) + list(header["species"])
+    return header
+
+
+def write_header(handle, header):
+    """Write the magic, the JSON header and padding to an open file."""
+    text = json.dumps(header, default=_plain).encode("utf-8")
+    length = len(MAGIC) + 4 + len(text)
+    text += b" "*(-length % _ALIGN)
+    handle.write(MAGIC + struct.pack("<I", len(text)) + text)
+
+
+def _plain(value):
+    """Convert NumPy scalars and arrays (a seed, say) to JSON types."""
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+
+def write_trajectory(filename, total, header):
+    """Write a whole trajectory array to a trajectory file."""
+    with open(filename, "wb") as handle:
+        write_header(handle, header)
+        handle.write(np.asarray(total, dtype="<f8").tobytes())
+
+
+def read_header(filename):
+    """Return (header dict, data offset) of a trajectory file."""
+    with open(filename, "rb") as handle:
+        if handle.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a trajectory file" % filename)
+        length = struct.unpack("<I", handle.read(4))[0]
+        header = json.loads(handle.read(length).decode("utf-8"))
+    return header, len(MAGIC) + 4 + length
+
+
+def read_trajectory(filename):
+    """Memory-map a trajectory file as a read-only (rows, columns) array.
+
+    The number of rows is taken from the file size, so a file still being
+    written (or cut short) can be read up to its last complete row.
+    """
+    header, offset = read_header(filename)
+    n_cols = len(header["columns"])
+    with open(filename, "rb") as handle:
+        handle.seek(0, 2)
+        n_rows = (handle.tell() - offset)//(8*n_cols)
+    if n_rows == 0:
+        return np.empty((0, n_cols))
+    return np.memmap(filename, dtype="<f8", mode="r", offset=offset,
+                     shape=(n_rows, n_cols))
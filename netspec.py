@@ -0,0 +1,510 @@
+#!/usr/bin/python
+"""
+Declarative reaction networks for both the ODE scripts and gsim_A.
+
+A Model lists species (with initial amounts) and reactions written as
+equations with a rate constant, e.g.
+
+    m = Model("pab1")
+    m.add_species("Pab", 13000)
+    m.add_species("iPab")
+    m.add_species("C", 28591)
+    m.add_reaction("deactivation", "Pab -> iPab", .01, law=ReducedArrhenius(80.))
+    m.add_reaction("reactivation", "iPab + C -> Pab + C", 5e-7)
+
+Rates are mass action, k*prod(reactant**order), unless a reaction gives an
+expression: Python source in the species names, k (the rate constant at
+the current temperature) and T, with sqrt, exp and log available, e.g.
+"k*AA*sqrt(iAA)". Temperature dependence is a rate law from ratelaw.
+
+Model.compile generates the right-hand side dz/dt = S^T r(z) as Python
+source: deriv writes out the rate vector r and the sparse product with the
+stoichiometry matrix S term by term for single states (faster than the
+hand-written deriv functions, which also recompute every rate constant at
+every call), and batch_deriv evaluates S^T r with a matrix product for a
+set of states at once. The Jacobian is generated the same way, from the
+derivatives of the mass-action rates (expression rates are differenced
+numerically), together with its sparsity pattern: jac is a dense odeint
+Dfun and sparse_jac a CSC matrix for the BDF and Radau solvers of
+solve_ivp, which then factorise with sparse LU. Generated code is cached by
+model structure and rate constants are cached per temperature. Model.network builds the
+gsim_A.Network of the same reactions for stochastic runs, so the ODE and
+SSA forms of a model cannot drift apart; there a reactant of order n > 1
+has the combinatorial propensity k*x*(x - 1)*...*(x - n + 1) in place of
+k*x**n.
+"""
+
+import copy
+import re
+
+import numpy as np
+from scipy.sparse import csc_matrix
+from gsim_A import Network, Reaction, Species
+from ratelaw import LRUCache, as_law
+
+_kernels = LRUCache(32)
+_identifier = re.compile(r"(?<![\w.])([A-Za-z_]\w*)")
+_functions = {"sqrt": np.sqrt, "exp": np.exp, "log": np.log, "np": np}
+
+
+def parse_side(side):
+    """Return {species: multiplicity} for one side of an equation, e.g.
+    "2 A + B"; "0" or an empty side means nothing."""
+    terms = {}
+    for term in side.split("+"):
+        term = term.strip()
+        if term in ("", "0"):
+            continue
+        parts = term.split()
+        n, name = (int(parts[0]), parts[1]) if len(parts) == 2 else (1, parts[0])
+        terms[name] = terms.get(name, 0) + n
+    return terms
+
+
+def expression_species(expression, names):
+    """Return the species of names used in expression, in order."""
+    used = set(_identifier.findall(expression))
+    return [s for s in names if s in used]
+
+
+def substitute(expression, names):
+    """Replace the identifiers of expression found in the dict names."""
+    return _identifier.sub(lambda m: names.get(m.group(1), m.group(1)), expression)
+
+
+class ModelReaction(object):
+    """One reaction of a Model."""
+    def __init__(self, name, equation, rate, law=None, expression=None):
+        if "->" not in equation:
+            raise ValueError("Equation %r has no '->'" % equation)
+        lhs, rhs = equation.split("->")
+        self.name = name
+        self.equation = equation
+        self.reactants = parse_side(lhs)
+        self.products = parse_side(rhs)
+        self.rate = rate
+        self.law = as_law(law)
+        self.expression = expression
+
+    def changes(self):
+        """Return {species: net change} of one firing."""
+        delta = dict((s, -n) for s, n in self.reactants.items())
+        for s, n in self.products.items():
+            delta[s] = delta.get(s, 0) + n
+        return dict((s, d) for s, d in delta.items() if d)
+
+    def rate_constant(self, T):
+        if self.law is None:
+            return self.rate
+        return self.rate*self.law.factor(T)
+
+
+class Model(object):
+    """A reaction network written once for the ODE and SSA engines."""
+    def __init__(self, name="model"):
+        self.name = name
+        self.names = []
+        self.initial = []
+        self.reactions = []
+
+    def add_species(self, name, initial=0):
+        if name in self.names:
+            raise ValueError("Species %s already defined" % name)
+        if name in ("k", "T") or name in _functions:
+            raise ValueError("%s is reserved in rate expressions" % name)
+        self.names.append(name)
+        self.initial.append(initial)
+
+    def add_reaction(self, name, equation, rate, law=None, expression=None):
+        rxn = ModelReaction(name, equation, rate, law, expression)
+        for s in list(rxn.reactants) + list(rxn.products) + self._refs(rxn):
+            if s not in self.names:
+                raise ValueError("Unknown species %s in reaction %s" % (s, name))
+        self.reactions.append(rxn)
+        return rxn
+
+    def _refs(self, rxn):
+        """Species named in the expression of rxn, in model order."""
+        if rxn.expression is None:
+            return []
+        return expression_species(rxn.expression, self.names)
+
+    def index(self, name):
+        return self.names.index(name)
+
+    def stoichiometry(self):
+        """Return S, the (reactions, species) matrix of net changes."""
+        S = np.zeros((len(self.reactions), len(self.names)))
+        for j, rxn in enumerate(self.reactions):
+            for s, d in rxn.changes().items():
+                S[j, self.index(s)] = d
+        return S
+
+    def key(self):
+        """The structure of the model, which determines the generated code."""
+        return (tuple(self.names),
+                tuple((tuple(sorted(r.reactants.items())),
+                       tuple(sorted(r.changes().items())), r.expression)
+                      for r in self.reactions))
+
+    def parameter(self, name):
+        """Return a parameter, named as for with_parameters."""
+        if "." in name:
+            rname, attr = name.rsplit(".", 1)
+            rxn = self._reaction(rname)
+            return rxn.rate if attr == "rate" else getattr(rxn.law, attr)
+        if name in self.names:
+            return self.initial[self.index(name)]
+        return self._reaction(name).rate
+
+    def with_parameters(self, values):
+        """Return a copy of the model with parameters changed.
+
+        values maps a species name to its initial amount, a reaction name
+        (or "reaction.rate") to its rate constant and "reaction.attribute"
+        to an attribute of its rate law, e.g. "deactivation.Ea". The
+        structure, and so the generated code, is unchanged.
+        """
+        m = Model(self.name)
+        m.names = list(self.names)
+        m.initial = list(self.initial)
+        m.reactions = [copy.copy(r) for r in self.reactions]
+        for name, value in values.items():
+            if "." in name:
+                rname, attr = name.rsplit(".", 1)
+                rxn = m._reaction(rname)
+                if attr == "rate":
+                    rxn.rate = value
+                    continue
+                if rxn.law is None or not hasattr(rxn.law, attr):
+                    raise ValueError("Reaction %s has no rate law parameter %s" % (rname, attr))
+                # a new law, as the old one has cached its factors
+                law = copy.copy(rxn.law)
+                setattr(law, attr, value)
+                law.cache = LRUCache(rxn.law.cache.maxsize)
+                rxn.law = law
+            elif name in m.names:
+                m.initial[m.index(name)] = value
+            else:
+                m._reaction(name).rate = value
+        return m
+
+    def _reaction(self, name):
+        for rxn in self.reactions:
+            if rxn.name == name:
+                return rxn
+        raise ValueError("Unknown reaction or species %s" % name)
+
+    def compile(self):
+        """Return the CompiledModel (rates are read now: recompile after
+        changing the model)."""
+        return CompiledModel(self)
+
+    def network(self, initial=None):
+        """Build a gsim_A.Network of the model with fresh Species, starting
+        from initial (default the model's initial amounts, rounded)."""
+        initial = self.initial if initial is None else initial
+        species = [Species(n, int(round(c))) for n, c in zip(self.names, initial)]
+        by_name = dict(zip(self.names, species))
+        reactions = []
+        for rxn in self.reactions:
+            ip = [by_name[s] for s in self.names if s in rxn.reactants
+                  for k in range(rxn.reactants[s])]
+            op = [by_name[s] for s in self.names if s in rxn.products]
+            changes = [(by_name[s], d) for s, d in sorted(rxn.changes().items())]
+            if rxn.expression is None:
+                reactions.append(MassActionReaction(rxn.name, ip, op, rxn.rate,
+                                                    rxn.law, changes))
+            else:
+                refs = [by_name[s] for s in self._refs(rxn)]
+                reactions.append(ExpressionReaction(rxn.name, ip, op, rxn.rate,
+                                                    rxn.law, changes,
+                                                    rxn.expression, refs))
+        return Network(species, reactions)
+
+
+class CompiledModel(object):
+    """The generated right-hand side of a Model.
+
+    deriv(z, t, T) has the odeint signature (pass args=(T,)); rhs(t, z, T)
+    the solve_ivp one. batch_deriv(Z, t, T) takes states as the columns of
+    a (species, n) array. Likewise jac(z, t, T) is the dense Jacobian for
+    odeint's Dfun and sparse_jac(t, z, T) the CSC Jacobian for solve_ivp,
+    whose nonzeros are those of jac_sparsity().
+    """
+    def __init__(self, model, cache_size=64):
+        self.names = list(model.names)
+        self.initial = np.array(model.initial, dtype=float)
+        self.stoich = model.stoichiometry()
+        self.reactions = list(model.reactions)
+        self.key = model.key()
+        self.source, kernels = _kernels.get(self.key, _build)
+        self._deriv, self._rates, self._jac_values, self._batch_jac_values = kernels
+        self._ST = self.stoich.T.copy()
+        self._constants = LRUCache(cache_size)
+        # Jacobian nonzeros in CSC order
+        n_sp = len(self.names)
+        entries = jacobian_entries(self.key)
+        self.jac_rows = np.array([e[0][0] for e in entries], dtype=np.int64)
+        self.jac_cols = np.array([e[0][1] for e in entries], dtype=np.int64)
+        self._indptr = np.searchsorted(self.jac_cols, np.arange(n_sp + 1))
+        # (entry, reaction, column, coefficient) of expression rates,
+        # which are differenced numerically
+        expression = set(j for j, r in enumerate(self.key[1]) if r[2] is not None)
+        self._fd = [(p, j, col, d) for p, ((row, col), terms) in enumerate(entries)
+                    for j, d in terms if j in expression]
+
+    def rate_constants(self, T):
+        """Return the rate constants at T as a tuple (cached per T)."""
+        return self._constants.get(T, self._rate_constants)
+
+    def _rate_constants(self, T):
+        return tuple(float(r.rate_constant(T)) for r in self.reactions)
+
+    def rates(self, z, T):
+        """Return the reaction rate vector at state z (or states, as the
+        columns of a 2-D array)."""
+        return self._rates(z, self.rate_constants(T), T)
+
+    def deriv(self, z, t, T):
+        return self._deriv(z, t, self.rate_constants(T), T)
+
+    def rhs(self, t, z, T):
+        return self._deriv(z, t, self.rate_constants(T), T)
+
+    def batch_deriv(self, Z, t, T):
+        return self._ST.dot(self._rates(Z, self.rate_constants(T), T))
+
+    def jac_values(self, z, t, T):
+        """Return the Jacobian nonzeros (at jac_rows, jac_cols) at state z."""
+        k = self.rate_constants(T)
+        values = self._jac_values(z, t, k, T)
+        if self._fd:
+            cols = sorted(set(col for p, j, col, d in self._fd))
+            h = 1e-7*np.maximum(np.abs(z[cols]), 1.)
+            Z = np.tile(np.asarray(z, dtype=float)[:, None], len(cols))
+            Z[cols, np.arange(len(cols))] += h
+            dr = (self._rates(Z, k, T) - self._rates(z, k, T)[:, None])/h
+            for p, j, col, d in self._fd:
+                values[p] += d*dr[j, cols.index(col)]
+        return values
+
+    def batch_jac_values(self, Z, t, T):
+        """Return the Jacobian nonzeros for the states in the columns of Z,
+        as a (nonzeros, states) array."""
+        k = self.rate_constants(T)
+        values = self._batch_jac_values(Z, t, k, T)
+        for col in sorted(set(col for p, j, col, d in self._fd)):
+            h = 1e-7*np.maximum(np.abs(Z[col]), 1.)
+            Zh = np.array(Z, dtype=float)
+            Zh[col] += h
+            dr = (self._rates(Zh, k, T) - self._rates(Z, k, T))/h
+            for p, j, c, d in self._fd:
+                if c == col:
+                    values[p] += d*dr[j]
+        return values
+
+    def jac(self, z, t, T):
+        J = np.zeros((len(self.names), len(self.names)))
+        J[self.jac_rows, self.jac_cols] = self.jac_values(z, t, T)
+        return J
+
+    def sparse_jac(self, t, z, T):
+        n = len(self.names)
+        return csc_matrix((self.jac_values(z, t, T), self.jac_rows, self._indptr),
+                          shape=(n, n))
+
+    def jac_sparsity(self):
+        n = len(self.names)
+        return csc_matrix((np.ones(len(self.jac_rows)), self.jac_rows, self._indptr),
+                          shape=(n, n))
+
+
+def _rate_source(key, z):
+    """Return the source of each reaction rate in terms of the variable
+    names z of the species."""
+    names, reactions = key
+    var = dict(zip(names, z))
+    out = []
+    for j, (reactants, changes, expression) in enumerate(reactions):
+        if expression is not None:
+            local = dict(var, k="k%d" % j)
+            out.append("(%s)" % substitute(expression, local))
+            continue
+        factors = ["k%d" % j]
+        for s, n in reactants:
+            factors.extend([var[s]]*n)
+        out.append("*".join(factors))
+    return out
+
+
+def jacobian_entries(key):
+    """Return the structural nonzeros of the Jacobian in CSC order.
+
+    Each is ((row, col), [(reaction, coefficient), ...]): J[row, col] is the
+    sum of coefficient*d(rate of reaction)/d(species col).
+    """
+    names, reactions = key
+    index = dict((s, i) for i, s in enumerate(names))
+    entries = {}
+    for j, (reactants, changes, expression) in enumerate(reactions):
+        if expression is None:
+            reads = [s for s, n in reactants]
+        else:
+            reads = expression_species(expression, names)
+        for s, d in changes:
+            for r in reads:
+                entries.setdefault((index[s], index[r]), []).append((j, d))
+    return sorted(entries.items(), key=lambda e: (e[0][1], e[0][0]))
+
+
+def _partial_source(reactants, j, species, var):
+    """Return the source of d(k_j*prod(reactants))/d(species)."""
+    factors = ["k%d" % j]
+    order = 0
+    for s, n in reactants:
+        if s == species:
+            order = n
+            n -= 1
+        factors.extend([var[s]]*n)
+    return ("%d*" % order if order > 1 else "") + "*".join(factors)
+
+
+def generate(key):
+    """Return the source of deriv, rates, jac_values and batch_jac_values
+    for a structure key."""
+    names, reactions = key
+    n_sp, n_rxn = len(names), len(reactions)
+    z = ["z%d" % i for i in range(n_sp)]
+    k = ", ".join("k%d" % j for j in range(n_rxn))
+    rates = _rate_source(key, z)
+    lines = ["def deriv(z, t, k, T):"]
+    add = lines.append
+    if n_sp:
+        add("    %s, = z.tolist()" % ", ".join(z))
+    if n_rxn:
+        add("    %s, = k" % k)
+    for j, r in enumerate(rates):
+        add("    r%d = %s" % (j, r))
+    terms = [[] for i in range(n_sp)]
+    index = dict((s, i) for i, s in enumerate(names))
+    for j, (reactants, changes, expression) in enumerate(reactions):
+        for s, d in changes:
+            coeff = "" if abs(d) == 1 else "%d*" % abs(d)
+            terms[index[s]].append("%s %sr%d" % ("+" if d > 0 else "-", coeff, j))
+    sums = []
+    for t in terms:
+        s = " ".join(t) or "0."
+        sums.append(s[2:] if s.startswith("+ ") else s)
+    add("    return np.array([%s])" % ", ".join(sums))
+    add("")
+    add("def rates(z, k, T):")
+    if n_sp:
+        add("    %s, = z" % ", ".join(z))
+        add("    one = np.ones_like(z0)")
+    if n_rxn:
+        add("    %s, = k" % k)
+    # zero-order rates are broadcast to the shape of the states
+    add("    return np.array([%s])" % ", ".join(
+        r if any(v in r for v in z) else "%s*one" % r for r in rates))
+    var = dict(zip(names, z))
+    values = []
+    for (row, col), contributions in jacobian_entries(key):
+        value = []
+        for j, d in contributions:
+            reactants, changes, expression = reactions[j]
+            if expression is not None:
+                continue # added by CompiledModel.jac_values
+            coeff = "" if abs(d) == 1 else "%d*" % abs(d)
+            value.append("%s %s%s" % ("+" if d > 0 else "-", coeff,
+                                      _partial_source(reactants, j, names[col], var)))
+        value = " ".join(value) or "0."
+        values.append(value[2:] if value.startswith("+ ") else value)
+    add("")
+    add("def jac_values(z, t, k, T):")
+    if n_sp:
+        add("    %s, = z.tolist()" % ", ".join(z))
+    if n_rxn:
+        add("    %s, = k" % k)
+    add("    return np.array([%s], dtype=float)" % ", ".join(values))
+    add("")
+    # the same for states as the columns of z, one row per nonzero
+    add("def batch_jac_values(z, t, k, T):")
+    if n_sp:
+        add("    %s, = z" % ", ".join(z))
+        add("    one = np.ones_like(z0)")
+    if n_rxn:
+        add("    %s, = k" % k)
+    add("    return np.array([%s], dtype=float)" % ", ".join(
+        v if any(s in v for s in z) else "%s*one" % v for v in values))
+    return "\n".join(lines) + "\n"
+
+
+def _build(key):
+    source = generate(key)
+    namespace = dict(_functions)
+    exec(compile(source, "<netspec model>", "exec"), namespace)
+    return source, (namespace["deriv"], namespace["rates"], namespace["jac_values"],
+                    namespace["batch_jac_values"])
+
+
+class MassActionReaction(Reaction):
+    """gsim_A reaction with mass-action propensity built by Model.network."""
+    def __init__(self, name, ip, op, baserate, law, changes):
+        Reaction.__init__(self, name, ip, op, None, baserate, law)
+        self.changes = changes
+
+    def prop(self, T):
+        """k*x*(x - 1)*... for a reactant of order > 1, so that it cannot
+        fire with fewer molecules than it consumes."""
+        alpha = self.rate_constant(T)
+        seen = []
+        for s in self.ip:
+            alpha *= s.count - seen.count(s)
+            seen.append(s)
+        return alpha
+
+    def mass_action(self):
+        return self.baserate, list(self.ip), self.law
+
+    def perform(self):
+        for s, d in self.changes:
+            s.count += d
+
+
+class ExpressionReaction(Reaction):
+    """gsim_A reaction with an expression propensity built by Model.network.
+
+    refs are the Species named in the expression; they are also added to ip
+    so the array engine syncs them before calling prop.
+    """
+    _functions = {}
+
+    def __init__(self, name, ip, op, baserate, law, changes, expression, refs):
+        Reaction.__init__(self, name, ip + [s for s in refs if s not in ip],
+                          op, None, baserate, law)
+        self.changes = changes
+        self.expression_source = expression
+        self.refs = refs
+
+    def _function(self):
+        key = (self.expression_source, tuple(s.name for s in self.refs))
+        if key not in self._functions:
+            args = ", ".join(("k", "T") + key[1])
+            self._functions[key] = eval("lambda %s: %s" % (args, self.expression_source),
+                                        dict(_functions))
+        return self._functions[key]
+
+    def prop(self, T):
+        return self._function()(self.rate_constant(T), T,
+                                *[s.count for s in self.refs])
+
+    def expression(self, count):
+        """prop written out for Network.compile (see gsim_compile)."""
+        local = dict((s.name, count(s)) for s in self.refs)
+        local.update(k="%(k)s", T="T")
+        return substitute(self.expression_source.replace("%", "%%"), local)
+
+    def perform(self):
+        for s, d in self.changes:
+            s.count += d
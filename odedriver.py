@@ -0,0 +1,346 @@
+#!/usr/bin/python
+"""
+Piecewise-temperature ODE runs.
+
+The ODE scripts set a global T, integrate each temperature segment on a
+fine np.arange grid with its own odeint call and vstack the pieces.
+integrate does the same in one call with T an explicit argument of the
+model, deriv(z, t, T) (the signature the notebooks pass to odeint with
+args=(T,), and that of netspec.CompiledModel.deriv): the integrator is
+restarted exactly at each breakpoint of the temperature schedule, takes
+adaptive steps in between and keeps each segment's dense output, so the
+returned Timecourse can be evaluated at any time instead of storing a grid.
+
+    course = integrate(deriv, zinit, 0, 100, [(0, 303), (10, 317), (20, 303)])
+    final = course.sample(np.arange(0, 100, .01))   # odeint layout
+
+integrate_batch runs K copies of a model from K initial states as one
+stacked system, for scans over initial conditions (par.py) or initial
+amounts (the Pab1 titrations of the notebooks), so the solver is set up
+once and each right-hand side call evaluates all K copies with array
+operations.
+
+Events stop a run (or are just recorded) when a condition is met, with the
+time found by root finding on the solver's interpolant rather than read
+off a grid:
+
+    course = integrate(deriv, z0, 0, 200, None,
+                       events=[Crossing(4, 1.), SteadyState(rtol=1e-4)])
+    course.event_time(0)        # time UP falls below 1 (NaN if it never does)
+"""
+
+import numpy as np
+from scipy.integrate import solve_ivp
+from scipy.optimize import brentq
+from scipy.sparse import csc_matrix, eye, kron
+from tschedule import TemperatureSchedule, as_schedule
+import resultcache
+
+
+class Timecourse(object):
+    """Dense solution of a piecewise-temperature run.
+
+    t and y are the solver's own steps (y is (species, steps), as from
+    solve_ivp); calling the timecourse interpolates. Each segment is
+    (t_start, t_end, T, OdeSolution).
+    """
+    def __init__(self, segments, schedule, t, y, t_events=(), stopped=None):
+        self.segments = segments
+        self.schedule = schedule
+        self.ends = np.array([s[1] for s in segments])
+        self.t = t
+        self.y = y
+        self.t_events = list(t_events)
+        self.stopped = stopped
+
+    def __call__(self, t):
+        """State at time t, or states (species, len(t)) for an array t."""
+        t = np.asarray(t, dtype=float)
+        if t.ndim == 0:
+            i = min(np.searchsorted(self.ends, t, side="left"), len(self.segments) - 1)
+            return self.segments[i][3](t)
+        out = np.empty((self.y.shape[0], len(t)))
+        which = np.minimum(np.searchsorted(self.ends, t, side="left"),
+                           len(self.segments) - 1)
+        for i in np.unique(which):
+            mask = which == i
+            out[:, mask] = self.segments[i][3](t[mask])
+        return out
+
+    def sample(self, times):
+        """Return the states at times as rows, the layout of odeint."""
+        return self(times).T
+
+    def temperature(self, t):
+        return self.schedule.temperatures(t)
+
+    def final(self):
+        return self.y[:, -1]
+
+    def event_time(self, j):
+        """First time event j occurred, or NaN."""
+        return self.t_events[j][0] if len(self.t_events[j]) else np.nan
+
+    def first_crossing(self, i, level, direction=-1):
+        """First time species i crosses level (downwards with direction=-1,
+        upwards with 1), found on the dense output between the steps where
+        it changes side; NaN if it never does."""
+        side = direction*(self.y[i] - level) >= 0
+        if side[0]:
+            return self.t[0]
+        hits = np.flatnonzero(side)
+        if not len(hits):
+            return np.nan
+        return brentq(lambda t: self(t)[i] - level, self.t[hits[0] - 1],
+                      self.t[hits[0]])
+
+
+class Crossing(object):
+    """Event: species i crosses level (downwards with direction=-1, upwards
+    with 1, either way with 0). i may be a name for a netspec model."""
+    def __init__(self, i, level, direction=-1, terminal=True):
+        self.i = i
+        self.level = level
+        self.direction = direction
+        self.terminal = terminal
+
+    def bind(self, deriv, names, t_last):
+        i = names.index(self.i) if isinstance(self.i, str) else self.i
+        return _event(lambda z, t, T: z[i] - self.level, self)
+
+
+class SteadyState(object):
+    """Event: every species changes by less than atol + rtol*|z| per unit
+    time. It only watches the run from time after on, by default the start
+    of the last temperature segment, so that a model starting at rest is
+    not reported steady before a shift."""
+    direction = -1
+
+    def __init__(self, rtol=1e-4, atol=1e-6, after=None, terminal=True):
+        self.rtol = rtol
+        self.atol = atol
+        self.after = after
+        self.terminal = terminal
+
+    def bind(self, deriv, names, t_last):
+        after = t_last if self.after is None else self.after
+
+        def g(z, t, T):
+            if t < after:
+                return 1.
+            rates = np.abs(deriv(z, t, T))/(self.atol + self.rtol*np.abs(z))
+            return np.max(rates) - 1.
+        return _event(g, self)
+
+
+def _event(g, like):
+    """Give g(z, t, T) the terminal and direction of an event."""
+    g.terminal = getattr(like, "terminal", False)
+    g.direction = getattr(like, "direction", 0)
+    return g
+
+
+def _met(g, z, t, T):
+    """Whether an event's condition already holds at (z, t)."""
+    value = g(z, t, T)
+    return value == 0 or g.direction*value > 0
+
+
+def _schedule(temp_fxn, t_start):
+    if temp_fxn is None or np.isscalar(temp_fxn):
+        return TemperatureSchedule([(t_start, temp_fxn)])
+    return as_schedule(temp_fxn)
+
+
+def integrate(deriv, z0, t_start, t_end, temp_fxn, jac=None, method="LSODA",
+              rtol=1e-6, atol=1e-6, events=(), **options):
+    """Integrate deriv(z, t, T) from z0 over [t_start, t_end].
+
+    temp_fxn is a temperature, a list of (time, temperature) tuples as in
+    gsim_A or a TemperatureSchedule; if it is None the model does not
+    depend on temperature and is called as deriv(z, t). deriv may also be a
+    netspec.CompiledModel, whose generated Jacobian is then used (dense for
+    LSODA, sparse for BDF and Radau), and which is called with T = None
+    when temp_fxn is; otherwise jac(z, t, T) may be given.
+    method, rtol, atol and other options are passed on to solve_ivp.
+
+    events are Crossing and SteadyState objects, or functions g(z, t, T)
+    with the terminal and direction attributes of solve_ivp events. Their
+    times are in the Timecourse's t_events; a terminal event ends the run
+    there, and its index is the Timecourse's stopped. An event whose
+    condition already holds at the start of the run, or comes to hold at a
+    change of temperature, occurs at that time (so the first time of an
+    event does not depend on whether it is terminal), and a terminal one
+    stops the run there.
+    Returns a Timecourse.
+    """
+    names = list(getattr(deriv, "names", []))
+    if jac is None and hasattr(deriv, "sparse_jac"):
+        if method in ("BDF", "Radau"):
+            jac = lambda z, t, T, model=deriv: model.sparse_jac(t, z, T)
+        else:
+            jac = deriv.jac
+    if hasattr(deriv, "deriv"):
+        deriv = deriv.deriv
+    elif temp_fxn is None:
+        deriv = _ignore_T(deriv)
+        jac = jac if jac is None else _ignore_T(jac)
+    schedule = _schedule(temp_fxn, t_start)
+    edges = [t_start] + schedule.breakpoints(t_start, t_end) + [t_end]
+    events = [ev.bind(deriv, names, edges[-2]) if hasattr(ev, "bind") else ev
+              for ev in events]
+    z = np.asarray(z0, dtype=float)
+    segments, ts, ys = [], [], []
+    t_events = [[] for ev in events]
+    stopped = None
+    held = set()
+    for a, b in zip(edges[:-1], edges[1:]):
+        T = schedule.temperature(a)
+        # the solver only finds roots after a; an event holding at a that
+        # did not at the end of the last segment happens at a, whether or
+        # not it is terminal
+        met = [j for j, g in enumerate(events)
+               if j not in held and _met(g, z, a, T)]
+        for j in met:
+            t_events[j].append(a)
+        terminal = [j for j in met if getattr(events[j], "terminal", False)]
+        if terminal:
+            stopped = terminal[0]
+            if not segments:
+                segments.append((a, a, T, _constant(z)))
+                ts.append(np.array([a]))
+                ys.append(z[:, None])
+            break
+        kwargs = dict(options)
+        if jac is not None:
+            kwargs["jac"] = lambda t, y, T=T: jac(y, t, T)
+        if events:
+            kwargs["events"] = [_event(lambda t, y, g=g, T=T: g(y, t, T), g)
+                                for g in events]
+        sol = solve_ivp(lambda t, y, T=T: deriv(y, t, T), (a, b), z,
+                        method=method, rtol=rtol, atol=atol, dense_output=True,
+                        **kwargs)
+        if sol.status < 0:
+            raise RuntimeError("Integration failed at t = %g: %s" % (sol.t[-1], sol.message))
+        segments.append((a, sol.t[-1], T, sol.sol))
+        # the first step of a segment repeats the end of the last one
+        ts.append(sol.t if not ts else sol.t[1:])
+        ys.append(sol.y if not ys else sol.y[:, 1:])
+        z = sol.y[:, -1]
+        for j in range(len(events)):
+            t_events[j].extend(sol.t_events[j])
+        held = set(j for j, g in enumerate(events) if _met(g, z, sol.t[-1], T))
+        if sol.status == 1:
+            stopped = [j for j, g in enumerate(events) if getattr(g, "terminal", False)
+                       and len(sol.t_events[j])][0]
+            break
+    return Timecourse(segments, schedule, np.concatenate(ts), np.hstack(ys),
+                      [np.array(t) for t in t_events], stopped)
+
+
+def _constant(z):
+    """Dense output of a run stopped where it started."""
+    return lambda t: z.copy() if np.ndim(t) == 0 else np.tile(z[:, None], (1, len(t)))
+
+
+def _ignore_T(f):
+    return lambda z, t, T: f(z, t)
+
+
+def integrate_batch(deriv, Z0, t_start, t_end, temp_fxn=None, times=None,
+                    vectorized=True, method="LSODA", rtol=1e-6, atol=1e-6,
+                    **options):
+    """Integrate K copies of deriv(z, t, T) from the rows of Z0 at once.
+
+    Z0 is (K, species). The copies are stacked into one system whose
+    right-hand side calls deriv once with the states as the columns of a
+    (species, K) array, which works for any deriv written with array
+    operations on z[i] (and for netspec.CompiledModel, through its
+    batch_deriv); with vectorized=False deriv is called per copy instead.
+    temp_fxn is as for integrate (None for deriv(z, t)). Returns the final
+    states (K, species), or with times the states (K, len(times), species).
+    The copies share the solver's steps. LSODA controls the error in a
+    weighted max-norm, which already holds each copy to rtol and atol; the
+    solve_ivp methods (RK45, BDF, Radau, ...) use an RMS norm over all
+    components, so for them the tolerances are divided by sqrt(K). BDF and
+    Radau are given the block-diagonal sparsity of the stacked Jacobian.
+    """
+    Z0 = np.asarray(Z0, dtype=float)
+    K, n = Z0.shape
+    jac = None
+    if hasattr(deriv, "batch_deriv"):
+        pattern = deriv.jac_sparsity()
+        f = deriv.batch_deriv
+        jac = _batch_jac(deriv, K, sparse=method in ("BDF", "Radau"))
+    else:
+        pattern = csc_matrix(np.ones((n, n)))
+        f = _ignore_T(deriv) if temp_fxn is None else deriv
+    if not vectorized:
+        f = lambda Z, t, T, f=f: np.column_stack([f(Z[:, k], t, T) for k in range(K)])
+
+    # The stacked state is species-major: y[i*K + k] is species i of copy k.
+    def stacked(y, t, T):
+        return np.asarray(f(y.reshape(n, K), t, T)).reshape(n*K)
+
+    if jac is None and method in ("BDF", "Radau") and "jac_sparsity" not in options:
+        options["jac_sparsity"] = kron(pattern, eye(K), format="csc")
+    if temp_fxn is None:
+        temp_fxn = TemperatureSchedule([(t_start, None)])
+    scale = 1. if method == "LSODA" else np.sqrt(K)
+    course = integrate(stacked, Z0.T.reshape(n*K), t_start, t_end, temp_fxn,
+                       jac=jac, method=method, rtol=rtol/scale, atol=atol/scale,
+                       **options)
+    if times is None:
+        return course.final().reshape(n, K).T
+    return course(times).reshape(n, K, len(times)).transpose(1, 2, 0)
+
+
+def _batch_jac(model, K, sparse):
+    """Return jac(y, t, T) of K stacked copies of a netspec.CompiledModel,
+    built from its generated Jacobian (CSC if sparse, else dense)."""
+    n = len(model.names)
+    copies = np.arange(K)
+    rows = (model.jac_rows[:, None]*K + copies).ravel()
+    cols = (model.jac_cols[:, None]*K + copies).ravel()
+    order = np.lexsort((rows, cols))
+    indices = rows[order]
+    indptr = np.searchsorted(cols[order], np.arange(n*K + 1))
+
+    def jac(y, t, T):
+        values = model.batch_jac_values(y.reshape(n, K), t, T).ravel()[order]
+        J = csc_matrix((values, indices, indptr), shape=(n*K, n*K))
+        return J if sparse else J.toarray()
+    return jac
+
+
+def segments_schedule(time_vec, temp_vec):
+    """Convert the notebooks' segment lists (end of each segment, its
+    temperature) to a list of (time, temperature) tuples starting at 0."""
+    assert len(temp_vec) == len(time_vec)
+    return [(0., temp_vec[0])] + [(t, T) for t, T in zip(time_vec[:-1], temp_vec[1:])]
+
+
+def run_simulation(deriv, zinit, temp_vec, time_vec, tstep):
+    """The notebooks' run_simulation on top of integrate.
+
+    deriv takes T as its third argument. Returns (z, times, T_list) sampled
+    every tstep as before, but from one adaptive run, which is looked up in
+    the active resultcache if there is one.
+    """
+    cache = resultcache.active()
+    if cache is not None:
+        key = resultcache.digest("run_simulation", deriv, zinit, temp_vec,
+                                 time_vec, tstep)
+        arrays = cache.cached(key, lambda: dict(zip(
+            ("z", "times", "T_list"),
+            map(np.asarray, _run_simulation(deriv, zinit, temp_vec, time_vec, tstep)))))
+        return arrays["z"], arrays["times"], arrays["T_list"].tolist()
+    return _run_simulation(deriv, zinit, temp_vec, time_vec, tstep)
+
+
+def _run_simulation(deriv, zinit, temp_vec, time_vec, tstep):
+    course = integrate(deriv, zinit, 0., time_vec[-1],
+                       segments_schedule(time_vec, temp_vec))
+    times = np.concatenate([np.arange(a, b, tstep) for a, b in
+                            zip([0.] + list(time_vec[:-1]), time_vec)])
+    return course.sample(times), times, [temp_vec[0]] + list(temp_vec)
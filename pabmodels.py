@@ -0,0 +1,56 @@
+#!/usr/bin/python
+"""
+The Pab1/chaperone models of the ODE scripts as netspec Models.
+
+pab1_v4 is the model of ODE-v4-mRNA-decay.py (chaperone mRNA and bulk mRNA
+both bound by Pab1), pab1_v5 that of ODE-v5.py (chaperone mRNA only, with
+an effective Pab1 concentration). Rates and initial amounts are those of the
+scripts; temperature enters through the two ReducedArrhenius laws (Ea = 80
+for deactivation, 125 for chaperone mRNA production, relative to 303 K).
+"""
+
+from netspec import Model
+from ratelaw import ReducedArrhenius
+
+# Parameters from von der Haar 2008
+total_HSP104 = 28591 # unshocked conditions
+total_cellular_mRNA = 36000 # Drummond 2015
+
+
+def _pab1_core(m, total_Pab1):
+    """Species and reactions shared by the v4 and v5 models."""
+    m.add_species("Pab", total_Pab1)
+    m.add_species("iPab", 0)
+    m.add_species("C", total_HSP104)
+    m.add_species("mRNAC", 5)
+    m.add_species("Pab_mRNAC", 0)
+    m.add_reaction("deactivation", "Pab -> iPab", .01, law=ReducedArrhenius(80.))
+    m.add_reaction("reactivation", "iPab + C -> Pab + C", .0000005)
+    m.add_reaction("synthesis", "mRNAC -> mRNAC + C", 1000)
+    m.add_reaction("degradation", "C -> 0", 0.005)
+    m.add_reaction("transcription", "0 -> mRNAC", .1, law=ReducedArrhenius(125.))
+    m.add_reaction("binding", "Pab + mRNAC -> Pab_mRNAC", .18) # Sachs 1987
+    m.add_reaction("unbinding", "Pab_mRNAC -> Pab + mRNAC", 1.8)
+    m.add_reaction("mRNA decay", "mRNAC -> 0", .03)
+    return m
+
+
+def pab1_v4(total_Pab1=50000):
+    """Model of ODE-v4-mRNA-decay.py.
+
+    Species: Pab, iPab, C, mRNAC, Pab_mRNAC, mRNAB, Pab_mRNAB
+    """
+    m = _pab1_core(Model("pab1_v4"), total_Pab1)
+    m.add_species("mRNAB", total_cellular_mRNA)
+    m.add_species("Pab_mRNAB", 0)
+    m.add_reaction("bulk binding", "Pab + mRNAB -> Pab_mRNAB", .18)
+    m.add_reaction("bulk unbinding", "Pab_mRNAB -> Pab + mRNAB", 1.8)
+    return m
+
+
+def pab1_v5(total_Pab1=13000):
+    """Model of ODE-v5.py.
+
+    Species: Pab, iPab, C, mRNAC, Pab_mRNAC
+    """
+    return _pab1_core(Model("pab1_v5"), total_Pab1)
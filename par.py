@@ -11,6 +11,9 @@ activating its own transcription
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.integrate import odeint
+from odedriver import integrate_batch
+from continuation import continuation
+from steady import steady_state
 
 plt.style.use('ggplot')
 
@@ -28,6 +31,12 @@ def deriv(z, t):
     dX = (beta_max * X ** n) / (K ** n + X ** n) - k_deg*X
 
     return(np.array([dX]))
+
+
+def deriv_beta(z, t, beta):
+    """deriv with beta_max as a parameter, for continuation."""
+    X = z[0]
+    return np.array([(beta * X ** n) / (K ** n + X ** n) - k_deg*X])
     
 
 t = np.arange(0, 10, 0.01)
@@ -46,13 +55,9 @@ z_f3 = odeint(deriv, np.array([0.7739]), t)
 
 
 
-# plot initial vs. final
+# plot initial vs. final; all initial values are integrated together
 Xi = np.arange(0.37, 0.4, 0.0001)
-Xf = []
-
-for i in Xi:
-    z_f = odeint(deriv, np.array([i]), t)
-    Xf.append(z_f[-1])
+Xf = integrate_batch(deriv, Xi[:, None], t[0], t[-1])
 
 plt.figure(figsize=(4,2.5))
 plt.plot(Xi, Xf, '.')
@@ -61,3 +66,12 @@ plt.ylabel("Final [X]")
 plt.tight_layout
 plt.show
 
+
+# equilibria as beta_max varies: the unstable branch is the threshold between
+# the two outcomes above, and the fold the beta_max below which X always dies
+branch = continuation(deriv_beta, zinit, beta_max, 0, 5, direction=-1)
+near = np.argmin(np.abs(branch.p - beta_max) + branch.stable)
+threshold = steady_state(deriv_beta, zinit, beta_max, guess=branch.z[near])
+print("Threshold at beta_max = %g: X = %g" % (beta_max, threshold[0]))
+for beta, X in branch.folds:
+    print("Fold at beta_max = %g, X = %g" % (beta, X[0]))
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+"""
+Temperature dependence of rate constants.
+
+A temperature-dependent reaction declares a rate law; its effective rate
+constant at temperature T is baserate*law.factor(T). Factors are cached per
+distinct temperature (with bounded LRU eviction), so an Arrhenius law costs
+one exponential per temperature of the schedule rather than one per SSA step.
+
+Linear       factor T (the original gsim_A TDReaction behaviour)
+Arrhenius    factor exp(-Ea/kB*(1/T - 1/T_ref)); Ea in J, T in K
+ReducedArrhenius
+             factor exp(Ea*(1 - T_ref/T)), the form of the ODE scripts, with
+             a dimensionless Ea
+Callable     factor fn(T) for any user function
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+KB = 1.381e-23 # Boltzmann constant, J/K
+
+
+class LRUCache(object):
+    """A dict with at most maxsize entries, evicting the least recently used.
+
+    The last (key, value) looked up is kept in last, so that asking for the
+    same key again (a rate law within one segment of a schedule) does not
+    touch the dict.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.last = ()
+
+    def get(self, key, compute):
+        """Return the cached value for key, computing it with compute(key)
+        if it is missing."""
+        last = self.last
+        if last and last[0] == key:
+            return last[1]
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            value = compute(key)
+            if len(self.data) >= self.maxsize:
+                self.data.popitem(last=False)
+        self.data[key] = value
+        self.last = (key, value)
+        return value
+
+    def __len__(self):
+        return len(self.data)
+
+
+class RateLaw(object):
+    """Base class: a temperature factor with a per-temperature cache.
+
+    Subclasses define _factor(T); factor(T) memoizes it.
+    """
+    def __init__(self, maxsize=128):
+        self.cache = LRUCache(maxsize)
+
+    def factor(self, T):
+        last = self.cache.last
+        if last and last[0] == T:
+            return last[1]
+        return self.cache.get(T, self._factor)
+
+    def _factor(self, T):
+        raise NotImplementedError
+
+    def __getstate__(self):
+        # the cache is cheap to rebuild and need not be pickled
+        state = dict(vars(self))
+        state["cache"] = LRUCache(self.cache.maxsize)
+        return state
+
+
+class Linear(RateLaw):
+    """Rate constant proportional to T."""
+    def _factor(self, T):
+        return T
+
+
+class Arrhenius(RateLaw):
+    """Arrhenius law, equal to 1 at the reference temperature T_ref."""
+    def __init__(self, Ea, T_ref=298., maxsize=128):
+        RateLaw.__init__(self, maxsize)
+        self.Ea = Ea
+        self.T_ref = T_ref
+
+    def _factor(self, T):
+        return np.exp(-self.Ea/KB*(1./T - 1./self.T_ref))
+
+
+class ReducedArrhenius(RateLaw):
+    """Arrhenius law written with a dimensionless activation energy, as
+    k0*np.exp(Ea*(1-(303./T))) in the ODE scripts; equal to 1 at T_ref."""
+    def __init__(self, Ea, T_ref=303., maxsize=128):
+        RateLaw.__init__(self, maxsize)
+        self.Ea = Ea
+        self.T_ref = T_ref
+
+    def _factor(self, T):
+        return np.exp(self.Ea*(1 - self.T_ref/float(T)))
+
+
+class Callable(RateLaw):
+    """Rate constant scaled by an arbitrary function of T."""
+    def __init__(self, fn, maxsize=128):
+        RateLaw.__init__(self, maxsize)
+        self.fn = fn
+
+    def _factor(self, T):
+        return self.fn(T)
+
+
+def as_law(law):
+    """Normalise a law given as a RateLaw, a callable, True (linear) or
+    False/None (temperature independent)."""
+    if law is None or law is False:
+        return None
+    if law is True:
+        return Linear()
+    if isinstance(law, RateLaw):
+        return law
+    if callable(law):
+        return Callable(law)
+    raise TypeError("Not a rate law: %r" % (law,))
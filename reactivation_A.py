@@ -27,8 +27,13 @@ class HeatInducedProduction(Reaction):
     Also dependent on the concentration of inactivated molecules in the
     simulation. Include this parameter in the ip list.
     """
+    default_law = "linear"
+    
     def prop(self, T):
-        return self.baserate*self.ip[0].count*T
+        return self.rate_constant(T)*self.ip[0].count
+        
+    def expression(self, count):
+        return "%%(k)s*%s" % count(self.ip[0])
         
     def perform(self):
         self.op[0].produce()
@@ -44,11 +49,18 @@ class HeatInducedInactivation(Reaction):
     surface area of the growing aggregated (inactivated) bulk species.
     Temperature scaling currently at 1/12.
     """
+    default_law = "linear"
+    
     def prop(self, T):
         if self.op[0].count == 0:
             return self.baserate*self.ip[0].count#*T
         else:
-            return self.baserate*self.ip[0].count*np.sqrt(self.op[0].count)*T#*0.8
+            return self.rate_constant(T)*self.ip[0].count*np.sqrt(self.op[0].count)#*0.8
+            
+    def expression(self, count):
+        """prop written out for Network.compile (see gsim_compile)."""
+        AA, iAA = count(self.ip[0]), count(self.op[0])
+        return "%%(c)s*%s if %s == 0 else %%(k)s*%s*sqrt(%s)" % (AA, iAA, AA, iAA)
     
     def perform(self):
         self.ip[0].destroy()
@@ -64,6 +76,10 @@ class Temp_Dimerization(Reaction):
     """        
     def prop(self, T):
         return self.ip[0].count*(self.ip[0].count-1)*self.baserate#*T#*0.8
+        
+    def expression(self, count):
+        A = count(self.ip[0])
+        return "%s*(%s-1)*%%(c)s" % (A, A)
     
     def perform(self):
         self.ip[0].destroy()
@@ -117,7 +133,7 @@ def main():
     #plt.ylabel("Temperature (T)")
     #plt.savefig("reactivation_p1(wsqrt).pdf")
     plt.show()
-    print np.mean(x[:,1])
+    print(np.mean(x[:,1]))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+"""
+Content-addressed on-disk cache of simulation results.
+
+Re-executing a notebook to change a plot reruns every timecourse and
+ensemble in it. When a cache is active, odedriver.run_simulation,
+Network.simulate (gsim and gsim_A, for seeded runs not streamed to a file)
+and gsim_ensemble.run_ensemble (seeded) look their results up by a digest
+of everything that determines them: the model (the code and the values of
+the globals of a deriv function, or every attribute of a network's
+species and reactions and the code of their classes), the parameters, the temperature schedule, the
+time grid and the seed. Results are stored as .npz files, and the least
+recently used are evicted once the cache exceeds its size limit.
+
+    import resultcache
+    resultcache.enable("~/.cache/agg_sim", max_bytes=2**30)
+
+or set AGG_SIM_CACHE to the directory before starting Python. A cached
+Network.simulate also restores the final counts of the species.
+"""
+
+import hashlib
+import os
+import types
+
+import numpy as np
+from ratelaw import LRUCache
+
+_active = []
+
+
+class ResultCache(object):
+    """A directory of .npz results named by key, at most max_bytes."""
+    def __init__(self, directory, max_bytes=2**30):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def get(self, key):
+        """Return the dict of arrays stored under key, or None."""
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                arrays = dict((k, data[k]) for k in data.files)
+        except (IOError, OSError, ValueError):
+            return None
+        # the modification time orders entries for eviction
+        os.utime(path, None)
+        return arrays
+
+    def put(self, key, arrays):
+        """Store a dict of arrays under key, then evict to max_bytes."""
+        path = self._path(key)
+        tmp = "%s.%d.tmp.npz" % (path[:-4], os.getpid())
+        np.savez(tmp, **arrays)
+        os.rename(tmp, path)
+        self.evict()
+
+    def cached(self, key, compute):
+        """Return the arrays under key, computing and storing them with
+        compute() if missing."""
+        arrays = self.get(key)
+        if arrays is None:
+            arrays = compute()
+            self.put(key, arrays)
+        return arrays
+
+    def entries(self):
+        """(mtime, size, path) of the entries, oldest first."""
+        out = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz") and ".tmp" not in name:
+                st = os.stat(os.path.join(self.directory, name))
+                out.append((st.st_mtime, st.st_size, os.path.join(self.directory, name)))
+        return sorted(out)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        for mtime, size, path in self.entries():
+            os.remove(path)
+
+
+def enable(directory=None, max_bytes=2**30):
+    """Make a ResultCache in directory (default $AGG_SIM_CACHE or
+    ~/.cache/agg_sim) the active cache and return it."""
+    if directory is None:
+        directory = os.environ.get("AGG_SIM_CACHE", "~/.cache/agg_sim")
+    del _active[:]
+    _active.append(ResultCache(directory, max_bytes))
+    return _active[0]
+
+
+def disable():
+    del _active[:]
+
+
+def active():
+    """The active ResultCache, or None."""
+    if not _active and os.environ.get("AGG_SIM_CACHE"):
+        enable()
+    return _active[0] if _active else None
+
+
+def digest(*parts):
+    """Return the hex SHA-1 of a canonical encoding of parts."""
+    h = hashlib.sha1()
+    _feed(h, parts, {})
+    return h.hexdigest()
+
+
+def _feed(h, obj, seen):
+    """Feed a canonical encoding of obj to the hash h."""
+    def tag(s):
+        h.update(s.encode("utf-8"))
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes,
+                                       np.generic)):
+        tag("%s:%r;" % (type(obj).__name__, obj))
+        return
+    if isinstance(obj, np.ndarray):
+        tag("ndarray:%s:%r;" % (obj.dtype.str, obj.shape))
+        h.update(np.ascontiguousarray(obj).tobytes() if obj.dtype != object
+                 else repr(obj.tolist()).encode("utf-8"))
+        return
+    if isinstance(obj, types.ModuleType):
+        tag("module:%s;" % obj.__name__)
+        return
+    if id(obj) in seen:
+        tag("cycle;")
+        return
+    # seen keeps the objects alive, so that the id of a temporary (a tuple
+    # or dict built while feeding) is not reused by another one
+    seen[id(obj)] = obj
+    if isinstance(obj, (list, tuple)):
+        tag("%s:%d[" % (type(obj).__name__, len(obj)))
+        for item in obj:
+            _feed(h, item, seen)
+        tag("]")
+    elif isinstance(obj, dict):
+        tag("dict:%d{" % len(obj))
+        for k in sorted(obj, key=repr):
+            _feed(h, k, seen)
+            _feed(h, obj[k], seen)
+        tag("}")
+    elif isinstance(obj, (set, frozenset)):
+        _feed(h, sorted(obj, key=repr), seen)
+    elif isinstance(obj, types.MethodType):
+        _feed(h, (obj.__func__, obj.__self__), seen)
+    elif isinstance(obj, types.FunctionType):
+        _feed_function(h, obj, seen)
+    elif isinstance(obj, types.CodeType):
+        tag("code:")
+        h.update(obj.co_code)
+        _feed(h, (obj.co_consts, obj.co_names), seen)
+    elif isinstance(obj, LRUCache):
+        tag("cache;") # memoized values only
+    elif isinstance(obj, type):
+        _feed_class(h, obj, seen)
+    elif hasattr(obj, "__dict__"):
+        cls = type(obj)
+        tag("%s.%s(" % (cls.__module__, cls.__name__))
+        _feed(h, vars(obj), seen)
+        tag(")")
+    else:
+        tag("%s.%s:%r;" % (type(obj).__module__, type(obj).__name__, obj))
+
+
+def _feed_function(h, f, seen):
+    """A function is its code, defaults, closure and the globals it reads
+    (the parameters the ODE scripts keep at module level)."""
+    code = f.__code__
+    _feed(h, code, seen)
+    _feed(h, f.__defaults__, seen)
+    _feed(h, [c.cell_contents for c in f.__closure__ or ()], seen)
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(const.co_names)
+    _feed(h, dict((n, f.__globals__[n]) for n in names if n in f.__globals__), seen)
+
+
+def _feed_class(h, cls, seen):
+    """A class is its name and the functions and plain values defined in it
+    and its bases, so that editing a prop or perform body changes the
+    digest of a network using it."""
+    h.update(("class:%s.%s(" % (cls.__module__, cls.__name__)).encode("utf-8"))
+    for c in cls.__mro__:
+        if c.__module__ in ("builtins", "__builtin__"):
+            continue
+        h.update(("%s.%s:" % (c.__module__, c.__name__)).encode("utf-8"))
+        for name in sorted(vars(c)):
+            value = vars(c)[name]
+            if isinstance(value, (staticmethod, classmethod)):
+                value = value.__func__
+            elif isinstance(value, property):
+                value = (value.fget, value.fset, value.fdel)
+            elif name.startswith("__") or not isinstance(
+                    value, (types.FunctionType, bool, int, float, str, type(None))):
+                continue
+            _feed(h, (name, value), seen)
+    h.update(b")")
+
+
+def classes(network):
+    """The classes of a network and of its species and reactions, whose
+    code is part of the key of its results."""
+    objects = [network] + list(network.species) + list(network.reactions)
+    return sorted(set(type(o) for o in objects),
+                  key=lambda c: (c.__module__, c.__name__))
+
+
+def cached_simulation(network, run, args):
+    """Network.simulate through the active cache: run(*args) unless a
+    result for the network and args (t_start, ..., seed, ...) is stored.
+    Only called for seeded runs that are not streamed to a file."""
+    from gsim_ensemble import describe
+    cache = active()
+    if cache is None:
+        return run(*args)
+    key = digest("simulate", describe(network), classes(network), args)
+
+    def compute():
+        out = run(*args)
+        return {"trajectory": np.asarray(out),
+                "counts": np.array([s.count for s in network.species])}
+    arrays = cache.cached(key, compute)
+    for s, c in zip(network.species, arrays["counts"]):
+        s.count = c.item()
+    return arrays["trajectory"]
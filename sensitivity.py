@@ -0,0 +1,116 @@
+#!/usr/bin/python
+"""
+Forward sensitivities of netspec models to their rate constants.
+
+Which rate constant controls the chaperone delay is answered today by
+perturbing one constant, rerunning and diffing. sensitivities instead
+integrates, alongside the state z, the sensitivities s_j = dz/dlog(k_j)
+to every rate constant,
+
+    ds_j/dt = J(z) s_j + S_j^T r_j(z)
+
+with J the generated Jacobian of the model and, for a mass-action
+reaction (r_j proportional to k_j), S_j^T r_j the column of the
+stoichiometry scaled by its rate; expression rates are differenced in k_j.
+One integration gives the trajectories of all sensitivities:
+
+    model = pab1_v4().compile()
+    sens = sensitivities(model, model.initial, 0, 100, [(0, 303), (10, 317), (20, 303)])
+    sens.relative(times)[:, model.names.index("C"), :]   # dlog C/dlog k_j
+
+The sensitivities are to the base rate constants of the reactions (the
+rate of Model.add_reaction), which scale k_j at every temperature.
+"""
+
+import numpy as np
+from scipy.sparse import block_diag
+from odedriver import integrate
+from tschedule import TemperatureSchedule
+
+
+class Sensitivities(object):
+    """States and sensitivities of a run, from its Timecourse over the
+    augmented state [z, dz/dlog(k_0), dz/dlog(k_1), ...]."""
+    def __init__(self, course, names, params, values):
+        self.course = course
+        self.names = names
+        self.params = params
+        self.values = np.asarray(values, dtype=float)
+
+    def _split(self, times):
+        y = self.course(np.atleast_1d(np.asarray(times, dtype=float)))
+        n, P = len(self.names), len(self.params)
+        z = y[:n].T
+        s = y[n:].reshape(P, n, -1).transpose(2, 1, 0)
+        return z, s
+
+    def state(self, times):
+        """States at times, (len(times), species)."""
+        return self._split(times)[0]
+
+    def log(self, times):
+        """dz/dlog(k), (len(times), species, params)."""
+        return self._split(times)[1]
+
+    def __call__(self, times):
+        """dz/dk, (len(times), species, params)."""
+        return self.log(times)/self.values
+
+    def relative(self, times):
+        """dlog(z)/dlog(k), (len(times), species, params); zero where a
+        species is zero."""
+        z, s = self._split(times)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            out = s/z[:, :, None]
+        out[~np.isfinite(out)] = 0.
+        return out
+
+
+def sensitivities(model, z0, t_start, t_end, temp_fxn, params=None,
+                  method="LSODA", rtol=1e-6, atol=1e-6, **options):
+    """Integrate a netspec.CompiledModel from z0 with the sensitivities
+    of the state to the rate constants of the reactions named in params
+    (default all). temp_fxn and the solver options are as for
+    odedriver.integrate; the sensitivities start at zero and are solved to
+    the same tolerances as the state. Returns a Sensitivities.
+    """
+    names = [r.name for r in model.reactions]
+    params = names if params is None else list(params)
+    index = [names.index(p) for p in params]
+    n, P = len(model.names), len(index)
+    # columns S_j^T of the parameters, and which are mass action
+    columns = model.stoich[index].T
+    expression = [m for m, j in enumerate(index) if model.key[1][j][2] is not None]
+    sparse = method in ("BDF", "Radau")
+
+    def deriv(y, t, T):
+        z = y[:n]
+        s = y[n:].reshape(P, n)
+        k = model.rate_constants(T)
+        r = model.rates(z, T)
+        J = model.jac(z, t, T)
+        forcing = columns*r[index]
+        for m in expression:
+            j = index[m]
+            h = 1e-7
+            kh = list(k)
+            kh[j] *= 1. + h
+            dr = (model._rates(z, kh, T)[j] - r[j])/h
+            forcing[:, m] = columns[:, m]*dr
+        ds = J.dot(s.T) + forcing
+        return np.concatenate([model.deriv(z, t, T), ds.T.ravel()])
+
+    # every block is solved with the model's Jacobian; the coupling of the
+    # sensitivities back to the state is left out of the Newton matrix
+    def jac(y, t, T):
+        if sparse:
+            return block_diag([model.sparse_jac(t, y[:n], T)]*(P + 1), format="csc")
+        return np.kron(np.eye(P + 1), model.jac(y[:n], t, T))
+
+    if temp_fxn is None:
+        temp_fxn = TemperatureSchedule([(t_start, None)])
+    y0 = np.concatenate([np.asarray(z0, dtype=float), np.zeros(n*P)])
+    course = integrate(deriv, y0, t_start, t_end, temp_fxn, jac=jac,
+                       method=method, rtol=rtol, atol=atol, **options)
+    values = [model.reactions[j].rate for j in index]
+    return Sensitivities(course, list(model.names), params, values)
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+"""
+Steady states of ODE models by root finding.
+
+The scripts read the post-shock steady state off the end of a long run
+(final[-1, :], x[0][-1]). steady_state solves deriv(z, t, T) = 0 directly
+with Powell's hybrid method and the model's Jacobian:
+
+    model = pab1_v5().compile()
+    z = steady_state(model, model.initial, 317)
+
+The fixed points of a network with conserved totals (Pab + iPab +
+Pab_mRNAC) are not isolated, so for each conservation law one equation is
+replaced by the law itself, holding the totals of the initial state. For a
+netspec.CompiledModel the laws come from its stoichiometry; for a plain
+deriv they may be given as the rows of conserved. When root finding fails,
+the model is integrated for a short time towards steady state and root
+finding restarts from there.
+
+steady_scan follows a branch of steady states along a titration or a
+temperature scan, starting each solve from the previous solution.
+"""
+
+import numpy as np
+from scipy.linalg import qr, svd
+from scipy.optimize import root
+from odedriver import integrate
+from tschedule import TemperatureSchedule
+
+
+def conservation_laws(stoich, tol=1e-10):
+    """Return L, whose rows are the conserved combinations L.z of a
+    network with stoichiometry matrix stoich (reactions, species)."""
+    stoich = np.atleast_2d(stoich)
+    u, s, vt = svd(stoich)
+    rank = int(np.sum(s > tol*max(s.max(), 1.))) if len(s) else 0
+    L = vt[rank:]
+    # clean up round-off so that exact laws stay exact
+    L[np.abs(L) < tol] = 0.
+    return L
+
+
+class SteadyStateProblem(object):
+    """deriv(z) = 0 at temperature T, with the conservation laws L.z =
+    totals in place of the equations of the species pivots."""
+    def __init__(self, deriv, T, jac=None, conserved=None):
+        if jac is None and hasattr(deriv, "jac"):
+            jac = deriv.jac
+        if conserved is None and hasattr(deriv, "stoich"):
+            conserved = conservation_laws(deriv.stoich)
+        if hasattr(deriv, "deriv"):
+            deriv = deriv.deriv
+        if T is None:
+            deriv = _ignore_T(deriv)
+            jac = jac if jac is None else _ignore_T(jac)
+        self.deriv = deriv
+        self.jac = jac
+        self.T = T
+        self.L = np.zeros((0, 0)) if conserved is None else np.atleast_2d(conserved)
+        self.pivots = qr(self.L, pivoting=True)[2][:len(self.L)] if len(self.L) else []
+
+    def residual(self, z, totals):
+        f = np.array(self.deriv(z, 0., self.T), dtype=float)
+        if len(self.pivots):
+            f[self.pivots] = self.L.dot(z) - totals
+        return f
+
+    def jacobian(self, z, totals):
+        if self.jac is None:
+            return None
+        J = np.array(self.jac(z, 0., self.T), dtype=float)
+        if len(self.pivots):
+            J[self.pivots] = self.L
+        return J
+
+    def totals(self, z):
+        return self.L.dot(z) if len(self.L) else np.zeros(0)
+
+
+def _ignore_T(f):
+    return lambda z, t, T: f(z, t)
+
+
+def _converged(problem, z, rtol, atol):
+    """Whether z is a non-negative state where no species changes by more
+    than atol + rtol*|z| per unit time."""
+    if not np.all(np.isfinite(z)) or np.any(z < -atol):
+        return False
+    f = np.asarray(problem.deriv(z, 0., problem.T))
+    return np.all(np.abs(f) <= atol + rtol*np.abs(z))
+
+
+def _solve(problem, guess, totals, method, rtol, atol):
+    jac = problem.jacobian if problem.jac is not None else None
+    sol = root(problem.residual, guess, args=(totals,), jac=jac, method=method)
+    return sol.x, _converged(problem, sol.x, rtol, atol)
+
+
+def steady_state(deriv, z0, T=None, guess=None, jac=None, conserved=None,
+                 method="hybr", rtol=1e-8, atol=1e-8, t_relax=10.,
+                 max_relax=1e4):
+    """Return the steady state of deriv(z, t, T) reached from z0.
+
+    deriv is a function (deriv(z, t) if T is None) or a netspec
+    CompiledModel, whose Jacobian and conservation laws are then used. The
+    conserved totals are those of z0; root finding starts from guess
+    (default z0). If it fails, the model is integrated from the start
+    point for t_relax, then ten times as long, up to max_relax, restarting
+    root finding after each. Raises RuntimeError if no steady state is
+    found.
+    """
+    problem = SteadyStateProblem(deriv, T, jac, conserved)
+    return _steady_state(problem, z0, guess, method, rtol, atol, t_relax, max_relax)
+
+
+def _steady_state(problem, z0, guess=None, method="hybr", rtol=1e-8, atol=1e-8,
+                  t_relax=10., max_relax=1e4):
+    z0 = np.asarray(z0, dtype=float)
+    totals = problem.totals(z0)
+    start = z0 if guess is None else guess
+    z, ok = _solve(problem, start, totals, method, rtol, atol)
+    # problem.deriv always takes T, so a model without one runs at T = None
+    temp = TemperatureSchedule([(0., problem.T)])
+    while not ok and t_relax <= max_relax:
+        start = integrate(problem.deriv, start, 0., t_relax, temp,
+                          jac=problem.jac).final()
+        z, ok = _solve(problem, start, totals, method, rtol, atol)
+        t_relax *= 10.
+    if not ok:
+        raise RuntimeError("No steady state found at T = %s" % problem.T)
+    return z
+
+
+def steady_scan(deriv, states, temperatures=None, jac=None, conserved=None,
+                **options):
+    """Steady states along a scan, each solve warm-started from the last.
+
+    states is a sequence of initial states (for a titration of initial
+    amounts) or a single one, temperatures a sequence of temperatures or a
+    single one (None for deriv(z, t)); they are broadcast against each
+    other. Returns the steady states as rows. options go to steady_state.
+    """
+    states = np.asarray(states, dtype=float)
+    temperatures = np.asarray(temperatures, dtype=object)
+    n = max(len(states) if states.ndim == 2 else 1, temperatures.size)
+    if states.ndim == 1:
+        states = np.tile(states, (n, 1))
+    if temperatures.ndim == 0:
+        temperatures = np.repeat(temperatures, n)
+    problems = {}
+    out = np.empty(states.shape)
+    guess = None
+    for k in range(n):
+        T = temperatures[k]
+        if T not in problems:
+            problems[T] = SteadyStateProblem(deriv, T, jac, conserved)
+        out[k] = guess = _steady_state(problems[T], states[k], guess, **options)
+    return out
@@ -0,0 +1,272 @@
+#!/usr/bin/python
+"""
+Parameter sweeps of ODE models over a process pool.
+
+The zheng-2016 scans loop over shock temperatures, build the initial state
+for each and call odeint on a fixed grid. sweep runs every point of a
+parameter grid (the Cartesian product of named value lists) through
+odedriver.integrate on a process pool and collects the requested outputs
+into LabelledArrays, whose leading axes are the grid parameters:
+
+    def build(point):
+        UP_0 = 0.0024*np.exp(0.215*point["temp"])
+        return deriv, np.array([HSP_0, HSF1_0, HSP_HSF1_0, HSP_UP_0, UP_0, YFP_0])
+
+    out = sweep(build, [("temp", np.linspace(35, 46))],
+                {"final": Final(), "clearance": Threshold(4, 1.)}, 200.)
+    out["clearance"].values      # time to clear unfolded protein per temp
+
+build(point) returns (deriv, z0) or (deriv, z0, temp_fxn), with deriv as
+for odedriver.integrate; it runs in the workers, so it must be importable
+(a module-level function) but the model it returns need not be picklable.
+ModelBuild(model, temp_fxn) is the build of a netspec Model whose points
+are parameters for Model.with_parameters. A point whose build, integration
+or outputs fail gives NaN outputs and is listed in the result's failed
+points rather than stopping the sweep. evaluate runs an arbitrary list of
+points the same way (see gsa.py).
+"""
+
+import itertools
+
+import numpy as np
+from scipy.optimize import minimize_scalar
+from odedriver import Crossing, SteadyState, integrate
+
+
+class LabelledArray(object):
+    """An ndarray with named axes and coordinate values along them."""
+    def __init__(self, values, dims, coords):
+        self.values = values
+        self.dims = list(dims)
+        self.coords = dict(coords)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def __array__(self, dtype=None):
+        return self.values if dtype is None else self.values.astype(dtype)
+
+    def sel(self, **points):
+        """Index by coordinate value (the nearest one) along named axes,
+        dropping those axes."""
+        index = []
+        for dim in self.dims:
+            if dim in points:
+                coord = np.asarray(self.coords[dim])
+                index.append(int(np.argmin(np.abs(coord - points[dim]))))
+            else:
+                index.append(slice(None))
+        dims = [d for d in self.dims if d not in points]
+        return LabelledArray(self.values[tuple(index)], dims,
+                             dict((d, self.coords[d]) for d in dims))
+
+    def __repr__(self):
+        return "LabelledArray(dims=%s, shape=%s)" % (self.dims, self.values.shape)
+
+
+class Final(object):
+    """The state at the end of the run."""
+    dims = ["species"]
+
+    def shape(self, n_species):
+        return (n_species,)
+
+    def compute(self, course, names):
+        return course.final()
+
+
+class Sample(object):
+    """Selected species (all by default) sampled at times."""
+    def __init__(self, times, species=None):
+        self.times = np.asarray(times, dtype=float)
+        self.species = species
+        self.dims = ["time", "species"]
+
+    def shape(self, n_species):
+        n = n_species if self.species is None else len(self.species)
+        return (len(self.times), n)
+
+    def compute(self, course, names):
+        x = course.sample(self.times)
+        # a run stopped at steady state stays there
+        x[self.times > course.t[-1]] = course.final()
+        if self.species is None:
+            return x
+        return x[:, [_species_index(s, names) for s in self.species]]
+
+
+class Threshold(object):
+    """First time a species crosses level (downwards with direction=-1,
+    upwards with 1), found by an integration event; NaN if it never does."""
+    dims = []
+
+    def __init__(self, species, level, direction=-1):
+        self.species = species
+        self.level = level
+        self.direction = direction
+
+    def shape(self, n_species):
+        return ()
+
+    def event(self, terminal):
+        return Crossing(self.species, self.level, self.direction, terminal)
+
+
+class SteadyTime(object):
+    """Time at which the run reaches steady state (see
+    odedriver.SteadyState); NaN if it does not by the end."""
+    dims = []
+
+    def __init__(self, rtol=1e-4, atol=1e-6, after=None):
+        self.rtol = rtol
+        self.atol = atol
+        self.after = after
+
+    def shape(self, n_species):
+        return ()
+
+    def event(self, terminal):
+        return SteadyState(self.rtol, self.atol, self.after, terminal)
+
+
+class Peak(object):
+    """Largest value of a species over the run, refined on the dense
+    solution around the largest step."""
+    dims = []
+
+    def __init__(self, species):
+        self.species = species
+
+    def shape(self, n_species):
+        return ()
+
+    def compute(self, course, names):
+        i = _species_index(self.species, names)
+        k = int(np.argmax(course.y[i]))
+        if k == 0 or k == len(course.t) - 1:
+            return course.y[i, k]
+        best = minimize_scalar(lambda t: -course(t)[i], method="bounded",
+                               bounds=(course.t[k - 1], course.t[k + 1]))
+        return max(-best.fun, course.y[i, k])
+
+
+class ModelBuild(object):
+    """A build function for a netspec Model: each point is a dict of
+    parameters for Model.with_parameters, run under temp_fxn (None for a
+    model without rate laws, which is then integrated with T = None)."""
+    def __init__(self, model, temp_fxn=None):
+        self.model = model
+        self.temp_fxn = temp_fxn
+
+    def __call__(self, point):
+        compiled = self.model.with_parameters(point).compile()
+        return compiled, compiled.initial, self.temp_fxn
+
+
+def _species_index(species, names):
+    if isinstance(species, str):
+        return names.index(species)
+    return species
+
+
+def grid_points(grid):
+    """Return the list of point dicts of a grid [(name, values), ...]."""
+    names = [name for name, values in grid]
+    return [dict(zip(names, combo)) for combo in
+            itertools.product(*[values for name, values in grid])]
+
+
+def _run_chunk(args):
+    """Worker: integrate a chunk of points and compute their outputs."""
+    build, points, outputs, t_start, t_end, steady, options = args
+    # a run only has to go on past its event if other outputs need it
+    terminal = len(outputs) == 1 and steady is None
+    events = [spec.event(terminal) for spec in outputs if hasattr(spec, "event")]
+    if steady is not None:
+        events.append(steady)
+    out = []
+    for point in points:
+        n = None
+        # any error in building, integrating or measuring a point fails
+        # that point only, so one bad parameter set cannot stop the sweep
+        try:
+            spec = build(point)
+            deriv, z0 = spec[0], spec[1]
+            n = len(z0)
+            temp_fxn = spec[2] if len(spec) > 2 else None
+            names = list(getattr(deriv, "names", []))
+            course = integrate(deriv, z0, t_start, t_end, temp_fxn,
+                               events=events, **options)
+            values, j = [], 0
+            for spec_ in outputs:
+                if hasattr(spec_, "event"):
+                    values.append(course.event_time(j))
+                    j += 1
+                else:
+                    values.append(spec_.compute(course, names))
+        except Exception:
+            out.append((n, None))
+            continue
+        out.append((n, values))
+    return out
+
+
+def evaluate(build, points, outputs, t_end, t_start=0., workers=None,
+             chunksize=16, steady=None, **options):
+    """Integrate build(point) for each of a list of point dicts.
+
+    outputs is a list of Final/Sample/Threshold/SteadyTime/Peak. Points
+    are sent to a process pool chunksize at a time (workers=1 runs in this
+    process). steady, a terminal odedriver.SteadyState, ends each run at
+    steady state; later samples are then the steady state. options go to
+    odedriver.integrate. Returns one array per output, with a first axis
+    over the points and NaN for points whose integration failed, and the
+    boolean array of failed points.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    tasks = [(build, points[i:i + chunksize], outputs, t_start, t_end, steady,
+              options) for i in range(0, len(points), chunksize)]
+    if workers == 1:
+        chunks = map(_run_chunk, tasks)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunks = list(pool.map(_run_chunk, tasks))
+    rows = [r for chunk in chunks for r in chunk]
+    n_species = ([n for n, r in rows if n is not None] or [0])[0]
+    results = []
+    for k, spec in enumerate(outputs):
+        values = np.full((len(points),) + spec.shape(n_species), np.nan)
+        for i, (n, r) in enumerate(rows):
+            if r is not None:
+                values[i] = r[k]
+        results.append(values)
+    return results, np.array([r[1] is None for r in rows], dtype=bool)
+
+
+def sweep(build, grid, outputs, t_end, t_start=0., workers=None, chunksize=16,
+          steady=None, **options):
+    """Integrate build(point) for every point of grid and collect outputs.
+
+    grid is a list of (name, values) pairs; outputs a dict (or list of
+    pairs) of name: Final/Sample/Threshold/SteadyTime/Peak. A sweep of a
+    single Threshold or SteadyTime stops each run at its event. The other
+    arguments are as for evaluate. Returns a dict of LabelledArrays, one
+    per output, with the grid axes first, and the list of failed points
+    under "failed".
+    """
+    outputs = list(outputs.items()) if isinstance(outputs, dict) else list(outputs)
+    points = grid_points(grid)
+    arrays, failed = evaluate(build, points, [spec for name, spec in outputs], t_end,
+                              t_start, workers, chunksize, steady, **options)
+    grid_shape = tuple(len(values) for name, values in grid)
+    coords = dict((name, np.asarray(values)) for name, values in grid)
+    result = {"failed": [p for p, f in zip(points, failed) if f]}
+    for values, (name, spec) in zip(arrays, outputs):
+        dims = [g for g, v in grid] + list(spec.dims)
+        out_coords = dict(coords)
+        if isinstance(spec, Sample):
+            out_coords["time"] = spec.times
+        result[name] = LabelledArray(values.reshape(grid_shape + values.shape[1:]),
+                                     dims, out_coords)
+    return result
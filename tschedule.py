@@ -0,0 +1,58 @@
+#!/usr/bin/python
+"""
+Piecewise-constant temperature schedules.
+
+A schedule is written as in gsim_A, a list of (time, temperature) tuples for
+each change in temperature, e.g. [(1,298), (30,315), (60,298)]. Before the
+first entry the first temperature holds. TemperatureSchedule finds the
+segment holding at a time by bisection and reports where it ends, so a
+simulation can keep T fixed for a whole segment and stop exactly at each
+breakpoint.
+"""
+
+from bisect import bisect_right
+
+import numpy as np
+
+
+class TemperatureSchedule(object):
+    """Step function of time built from a list of (time, temperature)."""
+    def __init__(self, temp_fxn):
+        pairs = sorted(temp_fxn)
+        self.temp_fxn = [tuple(p) for p in pairs]
+        self.times = [float(p[0]) for p in pairs]
+        self.temps = [p[1] for p in pairs]
+
+    def _index(self, t):
+        return max(bisect_right(self.times, t) - 1, 0)
+
+    def temperature(self, t):
+        """Return the temperature holding at time t."""
+        return self.temps[self._index(t)]
+
+    def segment(self, t):
+        """Return (T, t_next): the temperature at t and the time of the next
+        breakpoint after t (inf if there is none)."""
+        i = bisect_right(self.times, t)
+        return self.temps[max(i - 1, 0)], (self.times[i] if i < len(self.times) else np.inf)
+
+    def breakpoints(self, t0, t1):
+        """Return the breakpoints strictly between t0 and t1."""
+        return [b for b in self.times[bisect_right(self.times, t0):] if b < t1]
+
+    def temperatures(self, t):
+        """Vectorised temperature lookup for an array of times."""
+        i = np.maximum(np.searchsorted(self.times, t, side="right") - 1, 0)
+        return np.asarray(self.temps, dtype=float)[i]
+
+    def next_breakpoints(self, t):
+        """Vectorised next-breakpoint lookup for an array of times."""
+        ends = np.append(self.times, np.inf)
+        return ends[np.searchsorted(self.times, t, side="right")]
+
+
+def as_schedule(temp_fxn):
+    """Return temp_fxn as a TemperatureSchedule (None stays None)."""
+    if temp_fxn is None or isinstance(temp_fxn, TemperatureSchedule):
+        return temp_fxn
+    return TemperatureSchedule(temp_fxn)